@@ -0,0 +1,68 @@
+import argparse
+import logging
+import time
+from typing import Tuple
+
+import numpy as np
+
+from defl.aggregator import MultiKrumAggregator
+
+
+# Compare Multi-Krum client selection on count sketches against exact distances, on synthetic updates.
+
+def gen_updates(num_clients: int, num_byzantine: int, num_params: int, attack: str, seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    direction = rng.normal(0, 1e-2, num_params).astype(np.float32)
+    updates = direction + rng.normal(0, 1e-2, (num_clients, num_params)).astype(np.float32)
+    if attack == 'gaussian':
+        updates[:num_byzantine] += rng.normal(0, 1e-1, (num_byzantine, num_params)).astype(np.float32)
+    elif attack == 'sign':
+        updates[:num_byzantine] *= -4
+    return updates
+
+
+def select(aggregator: MultiKrumAggregator, updates: np.ndarray, num_byzantine: int) -> Tuple[float, np.ndarray]:
+    aggregator.clear_aggregator()
+    aggregator.reserve(updates.shape[0])
+    for update in updates:
+        aggregator.add_client_weight([update])
+    begin = time.perf_counter()
+    selected = aggregator.select_clients(num_byzantine)
+    return time.perf_counter() - begin, selected
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=30)
+    parser.add_argument('--byzantine', type=int, default=7)
+    parser.add_argument('--params', type=int, default=800_000, help='DenseNet-100 CIFAR-10 is ~0.8M')
+    parser.add_argument('--m', type=int, default=10)
+    parser.add_argument('--attack', choices=['gaussian', 'sign'], default='gaussian')
+    parser.add_argument('--dims', type=int, nargs='+', default=[256, 1024, 4096])
+    parser.add_argument('--exact_candidates', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--trials', type=int, default=5)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    print(f"{'sketch_dim':>10s} {'seconds':>10s} {'speedup':>8s} {'agreement':>10s} {'byz_selected':>12s}")
+    for dim in [0] + args.dims:
+        times, agreements, byzantine_selected = [], [], []
+        for trial in range(args.trials):
+            updates = gen_updates(args.clients, args.byzantine, args.params, args.attack, seed=trial)
+            exact = MultiKrumAggregator(args.m, num_workers=args.workers)
+            sketched = MultiKrumAggregator(args.m, num_workers=args.workers, sketch_dim=dim, sketch_seed=trial,
+                                           sketch_exact_candidates=args.exact_candidates)
+            expected = set(select(exact, updates, args.byzantine)[1].tolist())
+            elapsed, chosen = select(sketched, updates, args.byzantine)
+            times.append(elapsed)
+            agreements.append(len(expected & set(chosen.tolist())) / len(expected))
+            byzantine_selected.append(int(np.sum(chosen < args.byzantine)))
+        if dim == 0:
+            exact_time = np.mean(times)
+        print(f"{dim:>10d} {np.mean(times):>10.4f} {exact_time / np.mean(times):>8.2f} "
+              f"{np.mean(agreements):>10.3f} {np.mean(byzantine_selected):>12.2f}")
+
+
+if __name__ == '__main__':
+    main()
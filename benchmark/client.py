@@ -1,14 +1,15 @@
 import argparse
 import asyncio
+import functools
 import gc
 import json
 import os
-import threading
-import time
 import uuid
-from typing import Optional
+from typing import Awaitable, Callable, Optional, Set
 
-from defl.aggregator import MultiKrumAggregator, FedAvgAggregator, KrumAggregator, AbstractAggregator
+from defl.aggregator import MultiKrumAggregator, FedAvgAggregator, KrumAggregator, AbstractAggregator, \
+    MedianAggregator, TrimmedMeanAggregator, GeometricMedianAggregator, BulyanAggregator
+from defl.checkpoint import Checkpointer, ClientState
 from defl.committer import IpcCommitter
 from defl.committer.ipc_committer import ObsidoResponseQueue
 from defl.dataloader import Cifar10DataLoader, Sentiment140DataLoader, DataLoader
@@ -18,19 +19,188 @@ from defl.weightpoisoner import *
 from proto.defl_pb2 import Response, WeightsResponse
 
 
-def sleep_then_info(sleep_time: float, message: str):
-    time.sleep(sleep_time)
-    logging.info(message)
+class RoundScheduler:
+    """
+    The phases of a round as asyncio deadlines: the fetch window (passive push, then an active fetch), the GST
+    and the vote. Idle work queued with defer() runs in the background while waiting for the GST.
+    """
+
+    def __init__(self, committer: IpcCommitter, fetch_queue: ObsidoResponseQueue, gst_timeout: float):
+        self.committer = committer
+        self.fetch_queue = fetch_queue
+        self.gst_timeout = gst_timeout
+        self.gst_deadline = 0.0
+        self.idle_work: List[Callable[[], Awaitable]] = []
+        self.background: Set[asyncio.Task] = set()
+
+    async def fetch(self, fetch_timeout: float) -> WeightsResponse:
+        """Wait for a pushed WeightsResponse, actively fetching once the fetch window has passed."""
+        drain = asyncio.ensure_future(self.fetch_queue.drain())
+        try:
+            done, _ = await asyncio.wait({drain}, timeout=fetch_timeout)
+            if not done:
+                logging.info("PASSIVE received nothing. Fetching...")
+                await self.committer.fetch_w_last()
+            return await drain
+        finally:
+            drain.cancel()
+
+    def start_gst(self):
+        self.gst_deadline = asyncio.get_running_loop().time() + self.gst_timeout
+
+    def defer(self, work: Callable[[], Awaitable]):
+        """Run `work` in the next idle window."""
+        self.idle_work.append(work)
+
+    def _run_idle_work(self):
+        for work in self.idle_work:
+            task = asyncio.ensure_future(work())
+            self.background.add(task)
+            task.add_done_callback(self._background_done)
+        self.idle_work.clear()
+
+    def _background_done(self, task: asyncio.Task):
+        self.background.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.error("Background work failed: %r", task.exception())
+
+    async def wait_gst(self, next_epoch_id: int) -> bool:
+        """Wait out the GST; False if the epoch was closed without us in the meantime."""
+        self._run_idle_work()
+        closed = asyncio.ensure_future(self.fetch_queue.wait_for_epoch(next_epoch_id))
+        try:
+            done, _ = await asyncio.wait({closed}, timeout=max(0.0, self.gst_deadline - asyncio.get_running_loop().time()))
+        finally:
+            closed.cancel()
+        if done:
+            logging.info("Epoch %d already closed, skipping the vote.", next_epoch_id)
+            return False
+        logging.info("GST arrived.")
+        return True
+
+
+async def evaluate_aggregate(trainer: Trainer, epoch_id: int) -> Callable[[], Awaitable]:
+    """
+    Evaluate the freshly aggregated model now, or snapshot it for the background evaluator. Returns the work
+    reporting the result, which is deferred to an idle window in the background case.
+    """
+    if trainer.evaluator is None:
+        logging.info("Evaluating...")
+        score = await trainer.run(trainer.evaluate)
+
+        async def report():
+            logging.info('[AGGREGATED] metric_names: %s, metric_values: %s', str(trainer.metric_names), str(score))
+    else:
+        weights = await trainer.run(trainer.model.get_weights)
+
+        async def report():
+            await trainer.evaluator.evaluate(epoch_id, weights)
+    return report
+
+
+class Speculator:
+    """
+    Trains the next round ahead, during the GST window, on the updates the node has already committed for the
+    ongoing epoch. The round is kept if the authoritative WeightsResponse carries exactly those updates and
+    rolled back otherwise.
+    """
+
+    def __init__(self, committer: IpcCommitter, trainer: Trainer, min_clients: int, poll: float):
+        self.committer = committer
+        self.trainer = trainer
+        self.min_clients = min_clients
+        self.poll = poll
+        self.task: Optional[asyncio.Task] = None
+        self.training = False
+
+    def start(self, epoch_id: int, last_num_clients: int, callbacks: List[tf.keras.callbacks.Callback], evaluate: bool):
+        self.task = asyncio.create_task(self.speculate(epoch_id, self.min_clients or max(1, last_num_clients),
+                                                       callbacks, evaluate))
+
+    async def observe(self, epoch_id: int, min_clients: int) -> Optional[WeightsResponse]:
+        while True:
+            await self.committer.fetch_w_cur(min_clients)
+            try:
+                cur_resp: WeightsResponse = await asyncio.wait_for(self.committer.speculative_queue.get(), self.poll)
+            except asyncio.TimeoutError:
+                continue
+            if cur_resp.r_last_epoch_id > epoch_id:
+                return None
+            if cur_resp.r_last_epoch_id == epoch_id and len(cur_resp.w_last) >= min_clients:
+                return cur_resp
+            await asyncio.sleep(self.poll)
+
+    async def speculate(self, epoch_id: int, min_clients: int, callbacks: List[tf.keras.callbacks.Callback],
+                        evaluate: bool) -> Optional[dict]:
+        cur_resp = await self.observe(epoch_id, min_clients)
+        if cur_resp is None:
+            return None
+        logging.info("Speculating on %d updates of epoch %d...", len(cur_resp.w_last), epoch_id)
+        self.training = True
+        trainer = self.trainer
+        state = await trainer.run(trainer.snapshot)
+        try:
+            await trainer.run(trainer.aggregate_weights, cur_resp.w_last, epoch_id)
+            resume_state = await trainer.run(trainer.resume_state)
+            report = await evaluate_aggregate(trainer, epoch_id) if evaluate else None
+            await trainer.run(trainer.local_train, callbacks=callbacks)
+            weights = await trainer.run(trainer.get_serialized_weights)
+        except BaseException:
+            await trainer.run(trainer.restore, state)
+            raise
+        finally:
+            self.training = False
+        return {'epoch_id': epoch_id, 'w_last': dict(cur_resp.w_last), 'state': state, 'report': report,
+                'weights': weights, 'resume_state': resume_state}
+
+    async def take(self, fetch_resp: WeightsResponse) -> Optional[dict]:
+        """The speculative round if it was trained on exactly the updates of `fetch_resp`, else None."""
+        if self.task is None:
+            return None
+        if not self.training:
+            self.task.cancel()
+        try:
+            # shielded: if we are cancelled mid-training, the next take() still rolls the round back
+            speculation = await asyncio.shield(self.task)
+        except asyncio.CancelledError:
+            if not self.task.cancelled():
+                raise
+            speculation = None
+        self.task = None
+        if speculation is None:
+            return None
+        if speculation['epoch_id'] == fetch_resp.r_last_epoch_id and speculation['w_last'] == dict(fetch_resp.w_last):
+            logging.info("Speculation on epoch %d committed.", speculation['epoch_id'])
+            return speculation
+        logging.info("Speculation on epoch %d discarded, the committed updates differ.", speculation['epoch_id'])
+        await self.trainer.run(self.trainer.restore, speculation['state'])
+        return None
 
 
 def _get_aggregator(params: ClientConfig) -> AbstractAggregator:
+    num_workers = params.get('aggregator_workers') or 1
+    sketch_kwargs = dict(
+        sketch_dim=params.get('krum_sketch_dim') or 0,
+        sketch_seed=params.get('krum_sketch_seed') or 0,
+        sketch_exact_candidates=params.get('krum_sketch_exact_candidates') or 0,
+    )
     # get aggregator type
     if params['aggregator'] == 'multikrum':
-        return MultiKrumAggregator(params['multikrum_factor'])
+        return MultiKrumAggregator(params['multikrum_factor'], num_workers=num_workers, **sketch_kwargs)
     elif params['aggregator'] == 'krum':
-        return KrumAggregator()
+        return KrumAggregator(num_workers=num_workers, **sketch_kwargs)
     elif params['aggregator'] == 'fedavg':
-        return FedAvgAggregator()
+        return FedAvgAggregator(streaming=bool(params.get('fedavg_streaming')), num_workers=num_workers)
+    elif params['aggregator'] == 'median':
+        return MedianAggregator(num_workers=num_workers)
+    elif params['aggregator'] == 'trimmedmean':
+        return TrimmedMeanAggregator(num_workers=num_workers)
+    elif params['aggregator'] == 'geomed':
+        return GeometricMedianAggregator(tol=params.get('geomed_tol') or 1e-5,
+                                         max_iter=params.get('geomed_max_iter') or 10,
+                                         num_workers=num_workers)
+    elif params['aggregator'] == 'bulyan':
+        return BulyanAggregator(num_workers=num_workers)
     else:
         raise ValueError("Unknown aggregator {}".format(params['aggregator']))
 
@@ -88,43 +258,90 @@ async def start(params: ClientConfig):
         aggregator=aggregator,
         num_byzantine=params['num_byzantine'],
         dataloader=dataloader,
+        codec=params.get('codec') or 'raw',
+        codec_level=params.get('codec_level'),
+        codec_shuffle=params.get('codec_shuffle', True) is not False,
+        codec_threads=params.get('codec_threads') or 1,
+        topk_ratio=params.get('topk_ratio') or 0.01,
+        topk_threshold=params.get('topk_threshold'),
+        upload_delta=bool(params.get('upload_delta')),
+        decode_cache_size=params.get('decode_cache_size') or 0,
+        decode_workers=params.get('decode_workers') or 1,
+        eval_steps=params.get('eval_steps'),
+        eval_every=params.get('eval_every') or 1,
+        background_eval=bool(params.get('background_eval')),
     )
 
+    # a restarted client continues under its old name from the last epoch it aggregated
+    client_state = ClientState(params['state_dir'], codec=params.get('checkpoint_codec') or 'raw') \
+        if params.get('state_dir') else None
+    resumed = client_state.load() if client_state is not None else None
+
     # committer stuff
-    client_name = str(uuid.uuid4())
+    fetch_timeout: float = params['fetch'] / 1000.0
+    gst_timeout: float = params['gst'] / 1000.0
+    client_name = resumed['client_name'] if resumed is not None else str(uuid.uuid4())
     fetch_queue = ObsidoResponseQueue()
     host, port = params['host'].split(':')
-    committer = IpcCommitter(client_name, host, int(port), params['obsido_port'], fetch_queue)
+    committer = IpcCommitter(client_name, host, int(port), params['obsido_port'], fetch_queue,
+                             multiplexed=params.get('multiplexed', True) is not False,
+                             max_in_flight=params.get('max_in_flight') or 16,
+                             # a reply later than a whole GST is of no use to the round anymore
+                             response_timeout=params['response_timeout'] / 1000.0 if params.get('response_timeout')
+                             else gst_timeout,
+                             consensus_path=params.get('consensus_socket'),
+                             obsido_path=params.get('obsido_socket'),
+                             callback_path=params.get('callback_socket'))
     await committer.committer_bootstrap()
+    speculator = Speculator(committer, trainer, params.get('speculative_min_clients') or 0,
+                            (params.get('speculative_poll') or 500) / 1000.0) if params.get('speculative') else None
 
     # defl stuff
     epoch_id = -1
+    if resumed is not None:
+        epoch_id = resumed['epoch_id']
+        await trainer.run(trainer.resume, epoch_id, *resumed['groups'])
+        logging.info("Resumed [%s] from epoch %d.", client_name, epoch_id)
 
-    fetch_timeout: float = params['fetch'] / 1000.0
-    gst_timeout: float = params['gst'] / 1000.0
+    scheduler = RoundScheduler(committer, fetch_queue, gst_timeout)
     logging.info("+++++++++++++++++++++++++ [CLIENT] +++++++++++++++++++++++++")
     logging.info("+ client_name:        {:36s} +".format(client_name))
     logging.info("+ task:               {:36s} +".format(params['task']))
     logging.info("+ local_train_steps:  {:36s} +".format('%d' % params['local_train_steps']))
     logging.info("+ save_freq:          {:36s} +".format('%d' % params['save_freq']))
     logging.info("+ batch_size:         {:36s} +".format('%d' % params['batch_size']))
+    logging.info("+ codec:              {:36s} +".format(params.get('codec') or 'raw'))
+    logging.info("+ upload_delta:       {:36s} +".format(str(trainer.upload_delta)))
+    logging.info("+ background_eval:    {:36s} +".format(str(trainer.evaluator is not None)))
     logging.info("+           -------------- [DeFL] --------------           +")
     logging.info("+ attack:             {:36s} +".format(params['attack']))
     logging.info("+ aggregator:         {:36s} +".format(params['aggregator']))
+    logging.info("+ aggregator_workers: {:36s} +".format('%d' % (params.get('aggregator_workers') or 1)))
     logging.info("+ fetch_timeout:      {:36s} +".format('%.2f seconds' % fetch_timeout))
     logging.info("+ gst_timeout:        {:36s} +".format('%.2f seconds' % gst_timeout))
+    logging.info("+ speculative:        {:36s} +".format(str(speculator is not None)))
+    logging.info("+ multiplexed:        {:36s} +".format(str(committer.multiplexed)))
+    logging.info("+ max_in_flight:      {:36s} +".format('%d' % committer.max_in_flight))
+    logging.info("+ transport:          {:36s} +".format('uds' if committer.consensus_path or committer.obsido_path
+                                                          or committer.callback_path else 'tcp'))
+    logging.info("+ response_timeout:   {:36s} +".format('%.2f seconds' % committer.response_timeout))
     logging.info("+           ------------- [Attack] -------------           +")
     logging.info("+ gaussian_factor:    {:36s} +".format('{}'.format(params['gaussian_attack_factor'])))
     logging.info("+ signflip_factor:    {:36s} +".format('{}'.format(params['signflip_attack_factor'])))
     logging.info("+           -------------- [Krum] --------------           +")
     logging.info("+ multikrum_factor:   {:36s} +".format('%d' % params['multikrum_factor']))
+    logging.info("+ krum_sketch_dim:    {:36s} +".format('%d' % (params.get('krum_sketch_dim') or 0)))
     logging.info("+ num_byzantine:      {:36s} +".format('%d' % params['num_byzantine']))
     logging.info("++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++")
     logging.info("[INIT LOOP]")
     logging.info("Current epoch id is %d.", epoch_id)
-    epoch_id = await client_routine(committer, epoch_id, fetch_queue, 0, gst_timeout, trainer, callbacks, evaluate=False)
-    model_save_path = "./models/{}/epoch_{:05d}.h5".format(client_name, epoch_id)
+    epoch_id = await client_routine(committer, epoch_id, scheduler, 0, trainer, callbacks, evaluate=False,
+                                    speculator=speculator, client_state=client_state)
     save_freq: int = params['save_freq']
+    checkpointer = Checkpointer("./models/{}".format(client_name),
+                                keep_last=params.get('checkpoint_keep') or 3,
+                                keep_every=params.get('checkpoint_keep_every') or 0,
+                                codec=params.get('checkpoint_codec') or 'raw')
 
     i = 0
     while True:
@@ -133,29 +350,22 @@ async def start(params: ClientConfig):
         logging.info("[LOOP %d]", i)
         logging.info("Current epoch id is %d. Waiting PASSIVE %.0f seconds...", epoch_id, fetch_timeout)
         try:
-            epoch_id = await asyncio.wait_for(client_routine(committer, epoch_id, fetch_queue, fetch_timeout, gst_timeout, trainer, callbacks, evaluate=True), timeout=gst_timeout * 2.5)
+            epoch_id = await asyncio.wait_for(client_routine(committer, epoch_id, scheduler, fetch_timeout, trainer, callbacks, evaluate=True, speculator=speculator, client_state=client_state), timeout=gst_timeout * 2.5)
         except asyncio.TimeoutError:
             logging.critical("TIMEOUT FOR CLIENT ROUTINE! POSSIBLY A DEADLOCK OCCURRED.")
             # await committer.clear_session()
             continue
 
         if epoch_id % save_freq == 0:
-            model_save_path = "./models/{}/epoch_{:05d}.h5".format(client_name, epoch_id)
-            trainer.model.save(model_save_path)
-            logging.info("Saved model to %s", model_save_path)
-
+            # snapshot now, write while waiting for the next GST
+            weights, optimizer = await trainer.run(trainer.checkpoint_state)
+            scheduler.defer(functools.partial(checkpointer.save, epoch_id, weights, optimizer))
 
-async def active_fetch_after(sleep_time: float, committer: IpcCommitter):
-    await asyncio.sleep(sleep_time)
-    logging.info("PASSIVE received nothing. Fetching...")
-    await committer.fetch_w_last()
 
-
-async def client_routine(committer: IpcCommitter, epoch_id: int, fetch_queue: ObsidoResponseQueue, fetch_timeout: float, gst_timeout: float,
-                         trainer: Trainer, callbacks: List[tf.keras.callbacks.Callback], evaluate: bool = True):
-    active_fetch_task = asyncio.create_task(active_fetch_after(fetch_timeout, committer))
-    fetch_resp: WeightsResponse = await fetch_queue.drain()
-    active_fetch_task.cancel()
+async def client_routine(committer: IpcCommitter, epoch_id: int, scheduler: RoundScheduler, fetch_timeout: float,
+                         trainer: Trainer, callbacks: List[tf.keras.callbacks.Callback], evaluate: bool = True,
+                         speculator: Optional[Speculator] = None, client_state: Optional[ClientState] = None):
+    fetch_resp: WeightsResponse = await scheduler.fetch(fetch_timeout)
 
     logging.debug(
         f'Collected: {fetch_resp.request_uuid} with epoch_id={fetch_resp.r_last_epoch_id} and size of {fetch_resp.ByteSize()} bytes')
@@ -171,25 +381,42 @@ async def client_routine(committer: IpcCommitter, epoch_id: int, fetch_queue: Ob
     # if last_weights_to_check is not None:
     #     assert fetch_resp.w_last[client_name] == last_weights_to_check
     #     logging.info("REMOTE LAST_WEIGHTS OF THE CLIENT ARE THE SAME AS LOCAL LAST_WEIGHTS")
-    logging.info("Creating GST event...")
-    gst_event = threading.Thread(target=sleep_then_info, args=(gst_timeout, "GST arrived."))
-    gst_event.start()
+    logging.info("Starting GST timer...")
+    scheduler.start_gst()
+
+    evaluate = evaluate and fetch_resp.r_last_epoch_id % trainer.eval_every == 0
+    report = None
+    speculation = await speculator.take(fetch_resp) if speculator is not None else None
+    if speculation is not None:
+        # aggregated, evaluated and trained on these very updates while waiting for the last GST
+        report = speculation['report'] if evaluate else None
+        cur_weights = speculation['weights']
+        resume_state = speculation['resume_state']
+    else:
+        # aggregate weights
+        logging.info("Aggregating weights...")
+        await trainer.run(trainer.aggregate_weights, fetch_resp.w_last, fetch_resp.r_last_epoch_id)
+        resume_state = await trainer.run(trainer.resume_state) if client_state is not None else None
 
-    # aggregate weights
-    logging.info("Aggregating weights...")
-    trainer.aggregate_weights(fetch_resp.w_last)
+        # test accuracy
+        if evaluate:
+            report = await evaluate_aggregate(trainer, fetch_resp.r_last_epoch_id)
 
-    # test accuracy
-    if evaluate:
-        logging.info("Evaluating...")
-        score = trainer.evaluate()
-        logging.info('[AGGREGATED] metric_names: %s, metric_values: %s', str(trainer.metric_names), str(score))
+        # local_train
+        logging.info("Local training...")
+        await trainer.run(trainer.local_train, callbacks=callbacks)
 
-    # local_train
-    logging.info("Local training...")
-    trainer.local_train(callbacks=callbacks)
+        cur_weights = await trainer.run(trainer.get_serialized_weights)
 
-    cur_weights = trainer.get_serialized_weights()
+    if client_state is not None:
+        scheduler.defer(functools.partial(client_state.save, committer.client_name, fetch_resp.r_last_epoch_id,
+                                          *resume_state))
+
+    if report is not None:
+        if trainer.evaluator is None:
+            await report()
+        else:
+            scheduler.defer(report)
 
     # # test accuracy
     # score = await trainer.evaluate()
@@ -202,12 +429,19 @@ async def client_routine(committer: IpcCommitter, epoch_id: int, fetch_queue: Ob
         logging.critical("[ERROR] Updating weights failed!")
         return epoch_id
     logging.debug(f'Collected: {Response.Status.Name(upd_weight_resp.stat)} with {upd_weight_resp.ByteSize()} bytes')
+    if upd_weight_resp.stat == Response.Status.OK:
+        await trainer.run(trainer.commit_upload)
     # if upd_weight_resp.stat == Response.Status.OK:
     #     last_weights_to_check = cur_weights
 
+    if speculator is not None:
+        speculator.start(next_epoch_id, len(fetch_resp.w_last), callbacks,
+                         evaluate=next_epoch_id % trainer.eval_every == 0)
+
     # wait for GST
     logging.info("Waiting for GST...")
-    gst_event.join()
+    if not await scheduler.wait_gst(next_epoch_id):
+        return next_epoch_id
 
     # vote for new epoch
     logging.info("Voting new epoch %d...", next_epoch_id)
@@ -1 +1 @@
-__all__ = ['aggregator', 'committer', 'dataloader', 'trainer', 'types', 'weightpoisoner']
+__all__ = ['aggregator', 'checkpoint', 'committer', 'dataloader', 'serializer', 'trainer', 'types', 'weightpoisoner']
@@ -1,29 +1,187 @@
 import abc
 import logging
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple
 
 import numpy as np
 import tensorflow as tf
 
 
-def apply_delta(server_model: tf.keras.Model, delta: List[np.ndarray]):
-    old_weights = server_model.get_weights()
-    new_weights = [old + d for old, d in zip(old_weights, delta)]
-    server_model.set_weights(new_weights)
+# columns processed per kernel call; keeps an (n, chunk) slab of float32 in cache
+COLUMN_CHUNK_SIZE = 1 << 14
+
+
+def apply_delta(server_model: tf.keras.Model, delta: List[np.ndarray], base: Optional[List[np.ndarray]] = None):
+    """Set the trainable weights to `base` (the current ones by default) plus `delta`."""
+    if base is None:
+        base = [x.numpy() for x in server_model.trainable_weights]
+    new_weights = [old + d for old, d in zip(base, delta)]
+    tf.keras.backend.batch_set_value(zip(server_model.trainable_weights, new_weights))
+
+
+def _block_gram(deltas: np.ndarray, start: int, block_size: int,
+                rows: Optional[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    block = deltas[:, start:start + block_size].astype(np.float64, copy=False)
+    left = block if rows is None else block[rows]
+    return left @ block.T, np.einsum('ij,ij->i', block, block)
+
+
+def pairwise_squared_distances(deltas: np.ndarray, block_size: int = 1 << 16,
+                               executor: Optional[ThreadPoolExecutor] = None,
+                               rows: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Squared euclidean distances between the rows of `deltas` (or from the given `rows` to all of them),
+    via ||a||^2 + ||b||^2 - 2<a, b>. The Gram matrix is accumulated over column blocks so only an
+    (n, block_size) slab is materialised per worker.
+    """
+    num_clients = deltas.shape[0]
+    rows = None if rows is None else np.asarray(rows)
+    starts = range(0, deltas.shape[1], block_size)
+    if executor is None:
+        partials = (_block_gram(deltas, start, block_size, rows) for start in starts)
+    else:
+        partials = executor.map(lambda start: _block_gram(deltas, start, block_size, rows), starts)
+    targets = np.arange(num_clients) if rows is None else rows
+    gram = np.zeros((len(targets), num_clients), dtype=np.float64)
+    norms = np.zeros(num_clients, dtype=np.float64)
+    for partial_gram, partial_norms in partials:
+        gram += partial_gram
+        norms += partial_norms
+    distances = norms[targets, None] + norms[None, :] - 2 * gram
+    # cancellation may leave tiny negatives, and the self distances must be exactly zero
+    np.maximum(distances, 0, out=distances)
+    distances[np.arange(len(targets)), targets] = 0
+    return distances
 
 
 class AbstractAggregator(abc.ABC):
-    def __init__(self) -> None:
-        self.layers_weight: List[List[np.ndarray]] = []
+    def __init__(self, num_workers: int = 1) -> None:
+        # column chunks are reduced on this pool; NumPy releases the GIL inside the kernels
+        self.executor: Optional[ThreadPoolExecutor] = \
+            ThreadPoolExecutor(num_workers, thread_name_prefix='aggregator') if num_workers > 1 else None
+        # one float32 row per client, reused across rounds; layers are laid out back to back
+        self.buffer: Optional[np.ndarray] = None
+        self.shapes: List[Tuple[int, ...]] = []
+        self.offsets: List[int] = [0]
+        self.num_clients: int = 0
+        self.capacity: int = 1
+
+    @property
+    def num_params(self) -> int:
+        return self.offsets[-1]
+
+    @property
+    def updates(self) -> np.ndarray:
+        """The `(num_clients, num_params)` matrix of the updates added in this round."""
+        return self.buffer[:self.num_clients]
 
     def clear_aggregator(self):
-        self.layers_weight = []
+        self.num_clients = 0
+
+    def reserve(self, num_clients: int):
+        self.capacity = max(self.capacity, num_clients)
+        if self.buffer is not None and self.buffer.shape[0] < self.capacity:
+            self._resize(self.capacity)
+
+    def _resize(self, num_rows: int):
+        buffer = np.empty((num_rows, self.num_params), dtype=np.float32)
+        if self.buffer is not None:
+            buffer[:self.num_clients] = self.buffer[:self.num_clients]
+        self.buffer = buffer
+
+    def _adopt_layout(self, shapes: List[Tuple[int, ...]]) -> bool:
+        """Take the layer layout `shapes`, which may only change between rounds."""
+        shapes = [tuple(shape) for shape in shapes]
+        if shapes == self.shapes:
+            return False
+        if self.num_clients > 0:
+            raise ValueError("Client weight does not match the layout of the other clients")
+        self.shapes = shapes
+        self.offsets = np.cumsum([0] + [int(np.prod(shape)) for shape in shapes]).tolist()
+        return True
+
+    def split(self, flat: np.ndarray) -> List[np.ndarray]:
+        """Per-layer views of a flat parameter vector (or of the last axis of a matrix of them)."""
+        lead = flat.shape[:-1]
+        return [flat[..., begin:end].reshape(*lead, *shape)
+                for begin, end, shape in zip(self.offsets[:-1], self.offsets[1:], self.shapes)]
+
+    def map_columns(self, kernel: Callable[[np.ndarray], np.ndarray]) -> np.ndarray:
+        """Reduce the update matrix column chunk by column chunk, `kernel` maps (n, c) to (c,)."""
+        updates = self.updates
+        out = np.empty(self.num_params, dtype=np.float32)
+
+        def run(start: int):
+            out[start:start + COLUMN_CHUNK_SIZE] = kernel(updates[:, start:start + COLUMN_CHUNK_SIZE])
+
+        starts = range(0, self.num_params, COLUMN_CHUNK_SIZE)
+        if self.executor is None:
+            for start in starts:
+                run(start)
+        else:
+            # consume the iterator so worker exceptions propagate
+            list(self.executor.map(run, starts))
+        return out
+
+    def sum_columns(self, kernel: Callable[[np.ndarray, slice], np.ndarray]) -> np.ndarray:
+        """Sum per-chunk partials, `kernel` maps an (n, c) column chunk and its columns to an (n, ...) array."""
+        updates = self.updates
+
+        def run(start: int) -> np.ndarray:
+            columns = slice(start, start + COLUMN_CHUNK_SIZE)
+            return kernel(updates[:, columns], columns)
+
+        starts = range(0, self.num_params, COLUMN_CHUNK_SIZE)
+        partials = map(run, starts) if self.executor is None else self.executor.map(run, starts)
+        total = None
+        for partial in partials:
+            if total is None:
+                total = partial.astype(np.float64)
+            else:
+                total += partial
+        return total
+
+    def next_client(self, shapes: List[Tuple[int, ...]]) -> List[np.ndarray]:
+        """
+        Writable per-layer views of the row the next client is decoded into. The row only counts once
+        commit_client() is called, so a client that fails to decode can simply be skipped.
+        """
+        if self._adopt_layout(shapes) or self.buffer is None:
+            self.buffer = None
+            self._resize(self.capacity)
+        if self.num_clients == self.buffer.shape[0]:
+            self.capacity = 2 * self.num_clients
+            self._resize(self.capacity)
+        return self.split(self.buffer[self.num_clients])
+
+    def commit_client(self):
+        self.num_clients += 1
+
+    @property
+    def concurrent_rows(self) -> bool:
+        """Whether next_clients() hands out independent rows that can be filled concurrently."""
+        return True
+
+    def next_clients(self, shapes: List[Tuple[int, ...]], count: int) -> List[List[np.ndarray]]:
+        """Per-layer views of the next `count` rows, which only count once commit_clients(count) is called."""
+        self.next_client(shapes)
+        self.reserve(self.num_clients + count)
+        return [self.split(row) for row in self.buffer[self.num_clients:self.num_clients + count]]
+
+    def commit_clients(self, count: int):
+        self.num_clients += count
 
     def add_client_weight(self, client_weight: List[np.ndarray]):
-        if len(self.layers_weight) == 0:
-            self.layers_weight = [[] for _ in range(len(client_weight))]
-        for i, delta in enumerate(client_weight):
-            self.layers_weight[i].append(np.array(delta))
+        for view, delta in zip(self.next_client([np.shape(w) for w in client_weight]), client_weight):
+            view[...] = delta
+        self.commit_client()
+
+    def add_sparse_client(self, shapes: List[Tuple[int, ...]], sparse: List[Tuple[np.ndarray, np.ndarray]]):
+        """Add a sparse update given as per-layer (flat indices, values); densified into a row."""
+        for view, (indices, values) in zip(self.next_client(shapes), sparse):
+            view[...] = 0
+            view.flat[indices] += values
+        self.commit_client()
 
     @abc.abstractmethod
     def aggregate(self, num_byzantine: int):
@@ -31,26 +189,81 @@ class AbstractAggregator(abc.ABC):
 
 
 class FedAvgAggregator(AbstractAggregator):
+    def __init__(self, streaming: bool = False, accumulator_dtype=np.float64, num_workers: int = 1) -> None:
+        super().__init__(num_workers)
+        # streaming mode folds every client into a running sum instead of keeping its row
+        self.streaming = streaming
+        self.accumulator_dtype = accumulator_dtype
+        self.accumulator: Optional[np.ndarray] = None
+        self.scratch: Optional[np.ndarray] = None
+
+    def clear_aggregator(self):
+        super().clear_aggregator()
+        if self.accumulator is not None:
+            self.accumulator.fill(0)
+
+    def _ensure_accumulator(self, shapes: List[Tuple[int, ...]]):
+        if self._adopt_layout(shapes) or self.accumulator is None:
+            self.accumulator = np.zeros(self.num_params, dtype=self.accumulator_dtype)
+            self.scratch = np.empty(self.num_params, dtype=np.float32)
+
+    def next_client(self, shapes: List[Tuple[int, ...]]) -> List[np.ndarray]:
+        if not self.streaming:
+            return super().next_client(shapes)
+        self._ensure_accumulator(shapes)
+        return self.split(self.scratch)
+
+    def commit_client(self):
+        if self.streaming:
+            self.accumulator += self.scratch
+        super().commit_client()
+
+    @property
+    def concurrent_rows(self) -> bool:
+        # streaming mode only has the one scratch row
+        return not self.streaming
+
+    def add_sparse_client(self, shapes: List[Tuple[int, ...]], sparse: List[Tuple[np.ndarray, np.ndarray]]):
+        if not self.streaming:
+            return super().add_sparse_client(shapes, sparse)
+        self._ensure_accumulator(shapes)
+        # scatter-add the values, the rest of the row is zero
+        for begin, (indices, values) in zip(self.offsets, sparse):
+            self.accumulator[begin + indices.astype(np.int64)] += values
+        self.num_clients += 1
+
     def aggregate(self, num_byzantine: int):
-        delta = []
-        for layer in self.layers_weight:
-            delta.append(np.mean(layer, axis=0))
-        return delta
+        if self.streaming:
+            return self.split((self.accumulator / self.num_clients).astype(np.float32))
+        return self.split(self.map_columns(lambda block: np.mean(block, axis=0)))
+
+
+def median_kernel(block: np.ndarray) -> np.ndarray:
+    num_clients = block.shape[0]
+    half = num_clients // 2
+    if num_clients % 2 == 1:
+        return np.partition(block, half, axis=0)[half]
+    selected = np.partition(block, [half - 1, half], axis=0)
+    return (selected[half - 1] + selected[half]) / 2
+
+
+def trimmed_mean_kernel(block: np.ndarray, low: int, high: int) -> np.ndarray:
+    """Mean of the order statistics [low, high) of every column, found by selection instead of sorting."""
+    if low == 0 and high == block.shape[0]:
+        return np.mean(block, axis=0)
+    selected = np.partition(block, sorted({low, high - 1}), axis=0)
+    return np.mean(selected[low:high], axis=0)
 
 
 class MedianAggregator(AbstractAggregator):
     def aggregate(self, num_byzantine: int):
-        delta = []
-        for layer in self.layers_weight:
-            delta.append(np.median(layer, axis=0))
-        return delta
+        return self.split(self.map_columns(median_kernel))
 
 
 class TrimmedMeanAggregator(AbstractAggregator):
 
     def aggregate(self, num_byzantine: int):
-        delta = []
-        num_clients = len(self.layers_weight[0])
+        num_clients = self.num_clients
         beta = num_byzantine / num_clients
         exclusions = int(np.round(2 * beta * num_clients))
         low = exclusions // 2
@@ -59,48 +272,145 @@ class TrimmedMeanAggregator(AbstractAggregator):
         high = num_clients - high
         if low == high:
             high = min(num_clients, high + 1)
-        for i, layer in enumerate(self.layers_weight):
-            layer = np.sort(layer, axis=0)[low:high]
-            delta.append(np.mean(layer, axis=0))
-        return delta
+        return self.split(self.map_columns(lambda block: trimmed_mean_kernel(block, low, high)))
+
+
+def krum_scores(distances: np.ndarray, num_byzantine: int) -> np.ndarray:
+    """Sum of the squared distances from every row's client to its n - f - 2 nearest neighbours."""
+    k = max(1, distances.shape[1] - num_byzantine - 2)
+    # the self distance is zero and sorts first, hence k + 1 columns
+    return np.sort(distances, axis=1)[:, :k + 1].sum(axis=1)
 
 
 class MultiKrumAggregator(AbstractAggregator):
+    """
+    Multi-Krum. With `sketch_dim > 0` clients are scored on seeded count sketches of their updates (the same
+    on every node for the same seed), and the best `sketch_exact_candidates` of them are re-scored on exact
+    distances between them before the final selection.
+    """
 
-    def __init__(self, m) -> None:
-        super().__init__()
+    def __init__(self, m, num_workers: int = 1, sketch_dim: int = 0, sketch_seed: int = 0,
+                 sketch_exact_candidates: int = 0) -> None:
+        super().__init__(num_workers)
         self.m = m
+        self.sketch_dim = sketch_dim
+        self.sketch_seed = sketch_seed
+        self.sketch_exact_candidates = sketch_exact_candidates
+        self.sketch_signs: Optional[np.ndarray] = None
 
-    def aggregate(self, num_byzantine: int):
-        num_clients = len(self.layers_weight[0])
-        num_layers = len(self.layers_weight)
-        k = num_clients - num_byzantine - 2
-        k = max(1, k)
-        flattened_deltas = []
-        for client_index in range(num_clients):
-            client_data = []
-            for layer_index in range(num_layers):
-                client_data.append(np.array(self.layers_weight[layer_index][client_index]).flatten())
-            flattened_deltas.append(np.concatenate(client_data))
-        deltas = np.vstack(flattened_deltas)
-
-        distances = np.zeros((num_clients, num_clients))
-        for i in range(num_clients):
-            for j in range(i + 1, num_clients):
-                distances[i, j] = np.square(deltas[i] - deltas[j]).sum()
-                distances[j, i] = distances[i, j]
-
-        distances.sort(axis=0)
-        client_score = distances[:k + 1].sum(axis=0)
+    def sketch(self) -> np.ndarray:
+        """
+        Count sketch with seeded random signs whose buckets are the column offsets within each chunk modulo
+        `sketch_dim`, so projecting is an elementwise multiply and a fold instead of a scatter. It preserves
+        squared distances in expectation.
+        """
+        if self.sketch_signs is None or self.sketch_signs.shape[0] != self.num_params:
+            rng = np.random.default_rng(self.sketch_seed)
+            self.sketch_signs = rng.integers(0, 2, self.num_params, dtype=np.int8) * np.float32(2) - 1
+        signs, dim = self.sketch_signs, self.sketch_dim
+
+        def kernel(block: np.ndarray, columns: slice) -> np.ndarray:
+            signed = block * signs[columns]
+            full = signed.shape[1] // dim * dim
+            out = signed[:, :full].reshape(signed.shape[0], -1, dim).sum(axis=1)
+            out[:, :signed.shape[1] - full] += signed[:, full:]
+            return out
+
+        return self.sum_columns(kernel)
+
+    def select_clients(self, num_byzantine: int) -> np.ndarray:
+        num_clients = self.num_clients
+        deltas = self.updates
+
+        if self.sketch_dim > 0:
+            distances = pairwise_squared_distances(self.sketch())
+            client_score = krum_scores(distances, num_byzantine)
+            logging.info(f"Sketched client scores: {client_score.tolist()}")
+            if self.sketch_exact_candidates > 0:
+                # re-scored among themselves, so only the candidate rows are gathered and compared
+                candidates = np.sort(np.argsort(client_score)[:max(self.m, self.sketch_exact_candidates)])
+                exact = pairwise_squared_distances(deltas[candidates], executor=self.executor)
+                client_score = np.full(num_clients, np.inf)
+                client_score[candidates] = krum_scores(exact, num_byzantine)
+        else:
+            distances = pairwise_squared_distances(deltas, executor=self.executor)
+            client_score = krum_scores(distances, num_byzantine)
         logging.info(f"Client scores: {client_score.tolist()}")
-        best_clients = np.argsort(client_score)[:min(self.m, num_clients)]
-        delta = []
-        for layer in self.layers_weight:
-            delta.append(np.mean(np.stack(layer)[best_clients], axis=0))
-        return delta
+        return np.argsort(client_score)[:min(self.m, num_clients)]
+
+    def aggregate(self, num_byzantine: int):
+        best_clients = self.select_clients(num_byzantine)
+        return self.split(self.map_columns(lambda block: np.mean(block[best_clients], axis=0)))
 
 
 class KrumAggregator(MultiKrumAggregator):
 
-    def __init__(self) -> None:
-        super().__init__(1)
+    def __init__(self, num_workers: int = 1, **sketch_kwargs) -> None:
+        super().__init__(1, num_workers, **sketch_kwargs)
+
+
+class GeometricMedianAggregator(AbstractAggregator):
+    """
+    Geometric median (RFA) by smoothed Weiszfeld iterations, started from the coordinate-wise mean of the
+    round's updates so that every node iterates from the same point.
+    """
+
+    def __init__(self, tol: float = 1e-5, max_iter: int = 10, eps: float = 1e-6, num_workers: int = 1) -> None:
+        super().__init__(num_workers)
+        self.tol = tol
+        self.max_iter = max_iter
+        self.eps = eps
+
+    def _distances_to(self, median: np.ndarray) -> np.ndarray:
+        def kernel(block: np.ndarray, columns: slice) -> np.ndarray:
+            diff = block - median[columns]
+            return np.einsum('ij,ij->i', diff, diff)
+
+        return np.sqrt(self.sum_columns(kernel))
+
+    def aggregate(self, num_byzantine: int):
+        median = self.map_columns(lambda block: np.mean(block, axis=0))
+        for iteration in range(self.max_iter):
+            weights = 1 / np.maximum(self._distances_to(median), self.eps)
+            weights = (weights / weights.sum()).astype(np.float32)
+            new_median = self.map_columns(lambda block: weights @ block)
+            shift = np.linalg.norm(new_median - median)
+            median = new_median
+            if shift <= self.tol * max(np.linalg.norm(median), self.eps):
+                break
+        logging.info(f"Weiszfeld stopped after {iteration + 1} iterations, weights: {weights.tolist()}")
+        return self.split(median)
+
+
+class BulyanAggregator(AbstractAggregator):
+    """
+    Bulyan: pick n - 2f clients by repeated Krum over one distance matrix, then average, per coordinate,
+    the n - 4f selected values closest to their median.
+    """
+
+    def aggregate(self, num_byzantine: int):
+        num_clients = self.num_clients
+        if num_clients < 4 * num_byzantine + 3:
+            logging.warning(f"Bulyan needs n >= 4f + 3 clients, got n={num_clients} f={num_byzantine}")
+        distances = pairwise_squared_distances(self.updates, executor=self.executor)
+
+        remaining = list(range(num_clients))
+        selected = []
+        for _ in range(max(1, num_clients - 2 * num_byzantine)):
+            scores = krum_scores(distances[np.ix_(remaining, remaining)], num_byzantine)
+            selected.append(remaining.pop(int(np.argmin(scores))))
+        logging.info(f"Bulyan selected clients: {selected}")
+
+        beta = max(1, len(selected) - 2 * num_byzantine)
+
+        half = len(selected) // 2
+
+        def kernel(block: np.ndarray) -> np.ndarray:
+            # the beta values closest to the median are the sorted window with the smallest spread around it
+            block = np.sort(block[selected], axis=0)
+            median = block[half] if len(selected) % 2 == 1 else (block[half - 1] + block[half]) / 2
+            spread = np.maximum(median - block[:len(selected) - beta + 1], block[beta - 1:] - median)
+            window = np.argmin(spread, axis=0) + np.arange(beta)[:, None]
+            return np.mean(np.take_along_axis(block, window, axis=0), axis=0)
+
+        return self.split(self.map_columns(kernel))
@@ -0,0 +1,120 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from defl.serializer import QUANTIZED_CODECS, deserialize, serialize
+from defl.types import CODEC_TYPE
+
+# Checkpoint file: per group of arrays (e.g. weights, optimizer state), u64 payload length | payload,
+# the payloads in the wire format of defl.serializer.
+_LENGTH = struct.Struct('<Q')
+_CHECKPOINT_NAME = re.compile(r'^epoch_(-?\d+)\.ckpt$')
+
+
+class Checkpointer:
+    """
+    Writes snapshots of the model weights and optimizer state in the background. Files are renamed into
+    place once complete, and only the last `keep_last` checkpoints plus every `keep_every`-th epoch are kept.
+    """
+
+    def __init__(self, directory: str, keep_last: int = 3, keep_every: int = 0, codec: CODEC_TYPE = 'raw'):
+        if codec in QUANTIZED_CODECS or codec == 'topk':
+            raise ValueError("Checkpoints need a lossless codec, got {}".format(codec))
+        self.directory = directory
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+        self.codec: CODEC_TYPE = codec
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix='checkpointer')
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, epoch_id: int) -> str:
+        return os.path.join(self.directory, "epoch_{:05d}.ckpt".format(epoch_id))
+
+    def epochs(self) -> List[int]:
+        """The epochs with a complete checkpoint, oldest first."""
+        matches = [_CHECKPOINT_NAME.match(name) for name in os.listdir(self.directory)]
+        return sorted(int(match.group(1)) for match in matches if match is not None)
+
+    async def save(self, epoch_id: int, *groups: List[np.ndarray]) -> str:
+        return await asyncio.wrap_future(self.executor.submit(self._save, epoch_id, groups))
+
+    def _save(self, epoch_id: int, groups: List[List[np.ndarray]]) -> str:
+        path = self.path(epoch_id)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            for group in groups:
+                payload = serialize(group, self.codec)
+                f.write(_LENGTH.pack(len(payload)))
+                f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        logging.info("Saved checkpoint to %s", path)
+        self._prune()
+        return path
+
+    def _prune(self):
+        epochs = self.epochs()
+        keep = set(epochs[-self.keep_last:]) if self.keep_last > 0 else set(epochs)
+        if self.keep_every > 0:
+            keep.update(epoch for epoch in epochs if epoch % self.keep_every == 0)
+        for epoch in epochs:
+            if epoch not in keep:
+                os.remove(self.path(epoch))
+
+    def load(self, epoch_id: int) -> List[List[np.ndarray]]:
+        """The groups of arrays saved for `epoch_id`."""
+        with open(self.path(epoch_id), 'rb') as f:
+            data = f.read()
+        groups, offset = [], 0
+        while offset < len(data):
+            length, = _LENGTH.unpack_from(data, offset)
+            offset += _LENGTH.size
+            groups.append(deserialize(data[offset:offset + length]))
+            offset += length
+        return groups
+
+
+class ClientState:
+    """
+    What a restarted client resumes from: its name and the trainer state of the last epoch it aggregated,
+    kept in `directory` as client.json next to the checkpoint it points to.
+    """
+
+    def __init__(self, directory: str, codec: CODEC_TYPE = 'raw'):
+        # the previous checkpoint survives until client.json points past it
+        self.checkpointer = Checkpointer(directory, keep_last=2, codec=codec)
+        self.path = os.path.join(directory, 'client.json')
+
+    def load(self) -> Optional[Dict[str, Any]]:
+        """client.json plus the saved array `groups`, None when there is nothing to resume from."""
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            state = json.load(f)
+        try:
+            state['groups'] = self.checkpointer.load(state['epoch_id'])
+        except OSError as e:
+            # pruned or deleted by hand; starting over beats crashing on every restart
+            logging.warning("Cannot resume from epoch %d: %s", state['epoch_id'], e)
+            return None
+        return state
+
+    async def save(self, client_name: str, epoch_id: int, *groups: List[np.ndarray]):
+        await asyncio.wrap_future(self.checkpointer.executor.submit(self._save, client_name, epoch_id, groups))
+
+    def _save(self, client_name: str, epoch_id: int, groups: List[List[np.ndarray]]):
+        self.checkpointer._save(epoch_id, groups)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'client_name': client_name, 'epoch_id': epoch_id}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
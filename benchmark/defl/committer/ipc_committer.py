@@ -1,11 +1,21 @@
 import asyncio
 import logging
+import os
 import uuid
-from asyncio import IncompleteReadError, Queue, StreamReader, StreamWriter
-from typing import Dict, Optional
+from asyncio import Queue
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
 
-from defl.committer.utils import LengthDelimitedCodec
-from proto.defl_pb2 import ClientRequest, Response, RegisterInfo, WeightsResponse, ObsidoRequest
+from defl.committer.utils import FrameProtocol, LengthDelimitedCodec, PipelinedChannel
+from proto.defl_pb2 import ClientPush, ClientRequest, Response, RegisterInfo, WeightsResponse, ObsidoRequest
+
+_ABANDONED_CAPACITY = 1024
+
+
+def _port(server: asyncio.base_events.Server) -> int:
+    address = server.sockets[0].getsockname()
+    # a Unix domain socket is named by its path, not (host, port)
+    return address[1] if isinstance(address, tuple) else 0
 
 
 class IpcCommitter:
@@ -15,121 +25,157 @@ class IpcCommitter:
                  consensus_port: int,
                  obsido_port: int,
                  fetch_queue: Queue,
-                 listen_backlog=5):
+                 listen_backlog=5,
+                 speculative_queue: Optional[Queue] = None,
+                 multiplexed: bool = True,
+                 max_in_flight: int = 16,
+                 response_timeout: Optional[float] = None,
+                 consensus_path: Optional[str] = None,
+                 obsido_path: Optional[str] = None,
+                 callback_path: Optional[str] = None):
+        if callback_path is not None and not multiplexed:
+            raise ValueError("A callback socket needs the multiplexed response channel")
         self.client_name = client_name
         self.server_host = server_host
         self.consensus_port = consensus_port
         self.obsido_port = obsido_port
         self.listen_backlog = listen_backlog
+        # receive every Response and WeightsResponse as ClientPush frames on one long-lived connection
+        self.multiplexed = multiplexed
+        # Unix domain sockets to use instead of TCP, for a client running next to its node
+        self.consensus_path = consensus_path
+        self.obsido_path = obsido_path
+        # registered with the node, which may not share our working directory
+        self.callback_path = os.path.abspath(callback_path) if callback_path is not None else None
 
         # async net stuff
         self.passive_server: asyncio.base_events.Server
         self.active_server: asyncio.base_events.Server
-        self.replica_tx: StreamWriter
-        self.replica_rx: StreamReader
-        self.obsido_tx: StreamWriter
-        self.obsido_rx: StreamReader
         self.codec = LengthDelimitedCodec(8)
+        # requests to the node are pipelined, up to `max_in_flight` unacked ones per connection
+        self.max_in_flight = max_in_flight
+        self.replica, self.obsido = self._channels()
         self.fetch_queue = fetch_queue
+        # FETCH_W_CUR replies (the uncommitted epoch) go here rather than to `fetch_queue`
+        self.speculative_queue = speculative_queue if speculative_queue is not None else Queue()
 
-        # async sync stuff
-        self.__response_map: Dict[str, Queue] = {}
-        self.__response_map_lock = asyncio.Lock()
+        # responses are routed to the future of their request, registered before the request is sent
+        self.response_timeout = response_timeout
+        self.pending: Dict[str, asyncio.Future] = {}
+        # requests given up on, to tell late responses from unknown ones
+        self.abandoned: OrderedDict = OrderedDict()
+        self.late_responses = 0
+        self.unknown_responses = 0
 
     async def clear_session(self):
-        self.obsido_tx.close()
-        await self.obsido_tx.wait_closed()
-        self.obsido_rx, self.obsido_tx = await asyncio.open_connection(self.server_host, self.obsido_port)
-
-        self.replica_tx.close()
-        await self.replica_tx.wait_closed()
-        self.replica_rx, self.replica_tx = await asyncio.open_connection(self.server_host, self.consensus_port)
-
-        async with self.__response_map_lock:
-            logging.critical("Response map: %s", self.__response_map)
-            # clear the map
-            for v in self.__response_map.values():
-                del v
-            self.__response_map.clear()
-            logging.critical("Response map: %s", self.__response_map)
+        await self.obsido.close()
+        await self.replica.close()
+        self.replica, self.obsido = self._channels()
+        await self.connect_to_server()
+
+        logging.critical("Pending requests: %s", list(self.pending))
+        # failed rather than cancelled, so that their callers are not mistaken for cancelled themselves
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionResetError("Session cleared"))
+
+    def _channels(self) -> Tuple[PipelinedChannel, PipelinedChannel]:
+        return (PipelinedChannel(self.server_host, self.consensus_port, self.codec, self.max_in_flight,
+                                 self.consensus_path),
+                PipelinedChannel(self.server_host, self.obsido_port, self.codec, self.max_in_flight,
+                                 self.obsido_path))
 
     async def connect_to_server(self):
-        while True:
-            try:
-                self.replica_rx, self.replica_tx = await asyncio.open_connection(self.server_host, self.consensus_port)
-                self.obsido_rx, self.obsido_tx = await asyncio.open_connection(self.server_host, self.obsido_port)
-                break
-            except ConnectionRefusedError:
-                logging.warning('Connection refused, retrying...')
-                await asyncio.sleep(0.1)
+        self.replica.open()
+        self.obsido.open()
+        await asyncio.gather(self.replica.connected.wait(), self.obsido.connected.wait())
         logging.info('Connected to server')
 
-    async def transmit(self, client_request, tx, rx) -> bool:
+    async def transmit(self, client_request, channel: PipelinedChannel) -> bool:
         msg = client_request.SerializeToString()
         logging.debug(
             f'Transmitting [{client_request.request_uuid}] {client_request.Method.Name(client_request.method)} with {len(msg)} bytes')
-        await self.codec.async_length_delimited_send(tx, msg)
-        resp = await self.codec.async_length_delimited_recv(rx)
-        resp = resp.decode()
-        logging.debug(f'Immediate response: {resp}')
-        return resp == 'Ack'
-
-    async def handle_active(self, reader: StreamReader, writer: StreamWriter):
         try:
-            resp = await self.codec.async_length_delimited_recv(reader)
-        except IncompleteReadError:
-            # What the fuck with asyncio?
-            logging.warning('Incomplete read, closing writer...')
-            writer.close()
-            await writer.wait_closed()
-            return
+            acked = await channel.request(client_request.request_uuid, msg)
+        except ConnectionError as e:
+            logging.warning(f'[{client_request.request_uuid}] {e}')
+            return False
+        logging.debug(f'Immediate response for [{client_request.request_uuid}]: {"Ack" if acked else "rejected"}')
+        return acked
+
+    def handle_active(self) -> FrameProtocol:
+        return FrameProtocol(self._route_response, self.codec, 'RESPONSE')
 
-        logging.info(f'Received {len(resp)} bytes')
+    def handle_passive(self) -> FrameProtocol:
+        return FrameProtocol(self._route_weights, self.codec, 'LAST_WEIGHTS')
+
+    def handle_multiplexed(self) -> FrameProtocol:
+        return FrameProtocol(self._route_push, self.codec, 'PUSH')
+
+    async def _route_push(self, data: memoryview):
+        push = ClientPush()
+        push.ParseFromString(data)
+        body = push.WhichOneof('body')
+        if body == 'response':
+            await self._deliver_response(push.response)
+        elif body == 'weights':
+            await self._deliver_weights(push.weights)
+        else:
+            logging.warning('Received an empty push')
+
+    async def _route_response(self, data: memoryview):
         response = Response()
-        response.ParseFromString(resp)
-        logging.debug(f'HANDLE [{response.request_uuid}] {Response.Status.Name(response.stat)}\tresponse_uuid={response.response_uuid}')
-        logging.debug("acquiring `self.__response_map_lock`")
-        async with self.__response_map_lock:
-            if response.request_uuid in self.__response_map:
-                queue = self.__response_map[response.request_uuid]
-                del self.__response_map[response.request_uuid]
-            else:
-                logging.warning(f'Received response for unknown request {response.request_uuid}')
-        logging.debug("released `self.__response_map_lock`")
-        await queue.put(response)
+        response.ParseFromString(data)
+        await self._deliver_response(response)
 
-        writer.close()
-        await writer.wait_closed()
+    async def _route_weights(self, data: memoryview):
+        response = WeightsResponse()
+        response.ParseFromString(data)
+        await self._deliver_weights(response)
 
-    async def handle_passive(self, reader: StreamReader, writer: StreamWriter):
-        try:
-            resp = await self.codec.async_length_delimited_recv(reader)
-        except IncompleteReadError:
-            # What the fuck with asyncio?
-            logging.warning('LAST_WEIGHTS Incomplete read, closing writer...')
-            writer.close()
-            await writer.wait_closed()
+    async def _deliver_response(self, response: Response):
+        logging.debug(f'HANDLE [{response.request_uuid}] {Response.Status.Name(response.stat)}\tresponse_uuid={response.response_uuid}')
+        future = self.pending.pop(response.request_uuid, None)
+        if future is None:
+            if response.request_uuid in self.abandoned:
+                self.late_responses += 1
+                logging.warning(f'Received late response for request {response.request_uuid} ({self.late_responses} so far)')
+            else:
+                self.unknown_responses += 1
+                logging.warning(f'Received response for unknown request {response.request_uuid} ({self.unknown_responses} so far)')
             return
+        if not future.done():
+            future.set_result(response)
 
-        logging.info(f'LAST_WEIGHTS Received {len(resp)} bytes')
-        response = WeightsResponse()
-        response.ParseFromString(resp)
+    async def _deliver_weights(self, response: WeightsResponse):
         logging.debug(f'LAST_WEIGHTS HANDLE [{response.response_uuid}]')
-        await self.fetch_queue.put(response)
-
-        writer.close()
-        await writer.wait_closed()
-
-    async def collect(self, client_request_uuid) -> Optional[Response]:
-        request_uuid = client_request_uuid
-        response_queue: Queue = Queue(1)
-        logging.debug("acquiring `self.__response_map_lock`")
-        async with self.__response_map_lock:
-            self.__response_map[request_uuid] = response_queue
-        logging.debug("released `self.__response_map_lock`")
-        logging.debug(f'Waiting for response for {request_uuid} by queue.get()')
-        response: Response = await response_queue.get()
-        assert type(response) == Response
+        if response.speculative:
+            await self.speculative_queue.put(response)
+        else:
+            await self.fetch_queue.put(response)
+
+    def expect(self, request_uuid: str) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_uuid] = future
+        return future
+
+    def forget(self, request_uuid: str):
+        """Stop waiting for a response to `request_uuid`, if it has not arrived yet."""
+        if self.pending.pop(request_uuid, None) is not None:
+            self.abandoned[request_uuid] = None
+            while len(self.abandoned) > _ABANDONED_CAPACITY:
+                self.abandoned.popitem(last=False)
+
+    async def collect(self, request_uuid: str, future: asyncio.Future, timeout: Optional[float]) -> Optional[Response]:
+        logging.debug(f'Waiting for response for {request_uuid}')
+        try:
+            response: Response = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            logging.error(f'No response for [{request_uuid}] within {timeout:.2f} seconds')
+            return None
+        except ConnectionResetError:
+            logging.error(f'No response for [{request_uuid}], the session was cleared')
+            return None
         logging.debug(f'COLLECT [{response.request_uuid}] {Response.Status.Name(response.stat)}\tresponse_uuid={response.response_uuid}')
         return response
 
@@ -139,44 +185,62 @@ class IpcCommitter:
             request_uuid=str(uuid.uuid4()),
             register_info=RegisterInfo(
                 host='127.0.0.1',
-                port=self.active_server.sockets[0].getsockname()[1],
+                port=_port(self.active_server),
                 pasv_host='127.0.0.1',
-                pasv_port=self.passive_server.sockets[0].getsockname()[1],
+                pasv_port=_port(self.passive_server),
+                multiplexed=self.multiplexed,
+                callback_path=self.callback_path,
             ),
             client_name=self.client_name,
         )
-        return await self.transmit(client_request, self.obsido_tx, self.obsido_rx)
+        return await self.transmit(client_request, self.obsido)
 
     async def committer_bootstrap(self) -> bool:
         """Return if the client is successfully registered to the server"""
         await self.connect_to_server()
 
         # starting servers
-        self.active_server = await asyncio.start_server(self.handle_active, '127.0.0.1', 0)
-        self.passive_server = await asyncio.start_server(self.handle_passive, '127.0.0.1', 0)
-        logging.info('Started servers')
-
+        loop = asyncio.get_running_loop()
+        if self.callback_path is not None:
+            # a socket file left behind by a previous run would make the bind fail
+            if os.path.exists(self.callback_path):
+                os.remove(self.callback_path)
+            self.active_server = await loop.create_unix_server(self.handle_multiplexed, self.callback_path)
+            self.passive_server = self.active_server
+        elif self.multiplexed:
+            # responses and pushed weights share one connection, registered as both ports
+            self.active_server = await loop.create_server(self.handle_multiplexed, '127.0.0.1', 0)
+            self.passive_server = self.active_server
+        else:
+            self.active_server = await loop.create_server(self.handle_active, '127.0.0.1', 0)
+            self.passive_server = await loop.create_server(self.handle_passive, '127.0.0.1', 0)
+            asyncio.create_task(self.passive_server.serve_forever())
         asyncio.create_task(self.active_server.serve_forever())
-        asyncio.create_task(self.passive_server.serve_forever())
+        logging.info('Started servers')
         return await self.client_register()
 
     async def fetch_w_last(self):
+        await self.obsido_fetch(ObsidoRequest.Method.FETCH_W_LAST)
+
+    async def fetch_w_cur(self, min_clients: int = 0):
+        """
+        Ask for the weights committed so far in the ongoing epoch, answered on `speculative_queue`. Until the
+        epoch has `min_clients` updates the reply carries only the epoch id.
+        """
+        await self.obsido_fetch(ObsidoRequest.Method.FETCH_W_CUR, min_clients)
+
+    async def obsido_fetch(self, method: int, min_clients: int = 0):
         client_request = ObsidoRequest(
-            method=ObsidoRequest.Method.FETCH_W_LAST,
+            method=method,
             request_uuid=str(uuid.uuid4()),
             client_name=self.client_name,
             register_info=None,
+            min_clients=min_clients,
         )
-        try:
-            assert await self.transmit(client_request, self.obsido_tx, self.obsido_rx)
-        except AssertionError:
-            logging.error('Failed to transmit FETCH_W_LAST')
-        except asyncio.CancelledError:
-            self.obsido_tx.close()
-            await self.obsido_tx.wait_closed()
-            self.obsido_rx, self.obsido_tx = await asyncio.open_connection(self.server_host, self.obsido_port)
-
-    async def update_weights(self, target_epoch_id: int, weights_b: bytes) -> Optional[Response]:
+        if not await self.transmit(client_request, self.obsido):
+            logging.error(f'Failed to transmit {ObsidoRequest.Method.Name(method)}')
+
+    async def update_weights(self, target_epoch_id: int, weights_b: bytes, timeout: Optional[float] = None) -> Optional[Response]:
         client_request = ClientRequest(
             method=ClientRequest.Method.UPD_WEIGHTS,
             request_uuid=str(uuid.uuid4()),
@@ -184,26 +248,9 @@ class IpcCommitter:
             target_epoch_id=target_epoch_id,
             weights=weights_b,
         )
-        try:
-            assert await self.transmit(client_request, self.replica_tx, self.replica_rx)
-        except AssertionError:
-            logging.error('Failed to transmit UPD_WEIGHTS')
-            return None
-        except asyncio.CancelledError:
-            self.replica_tx.close()
-            await self.replica_tx.wait_closed()
-            self.replica_rx, self.replica_tx = await asyncio.open_connection(self.server_host, self.consensus_port)
-        try:
-            return await self.collect(client_request.request_uuid)
-        except asyncio.CancelledError:
-            logging.debug("acquiring `self.__response_map_lock`")
-            async with self.__response_map_lock:
-                if client_request.request_uuid in self.__response_map:
-                    del self.__response_map[client_request.request_uuid]
-            logging.debug("released `self.__response_map_lock`")
-            return None
+        return await self.submit(client_request, timeout)
 
-    async def new_epoch_vote(self, target_epoch_id: int) -> Optional[Response]:
+    async def new_epoch_vote(self, target_epoch_id: int, timeout: Optional[float] = None) -> Optional[Response]:
         client_request = ClientRequest(
             method=ClientRequest.Method.NEW_EPOCH_VOTE,
             request_uuid=str(uuid.uuid4()),
@@ -211,29 +258,39 @@ class IpcCommitter:
             target_epoch_id=target_epoch_id,
             weights=None,
         )
+        return await self.submit(client_request, timeout)
+
+    async def submit(self, client_request: ClientRequest, timeout: Optional[float] = None) -> Optional[Response]:
+        """
+        Send a request to the replica and wait up to `timeout` (default `response_timeout`) seconds for its
+        response. None if it was not acked or timed out; cancelling the caller cancels the request.
+        """
+        request_uuid = client_request.request_uuid
+        # the response may come back before the ack does
+        future = self.expect(request_uuid)
         try:
-            assert await self.transmit(client_request, self.replica_tx, self.replica_rx)
-        except AssertionError:
-            logging.error('Failed to transmit NEW_EPOCH_VOTE')
-            return None
-        except asyncio.CancelledError:
-            self.replica_tx.close()
-            await self.replica_tx.wait_closed()
-            self.replica_rx, self.replica_tx = await asyncio.open_connection(self.server_host, self.consensus_port)
-        try:
-            return await self.collect(client_request.request_uuid)
-        except asyncio.CancelledError:
-            logging.debug("acquiring `self.__response_map_lock`")
-            async with self.__response_map_lock:
-                if client_request.request_uuid in self.__response_map:
-                    del self.__response_map[client_request.request_uuid]
-            logging.debug("released `self.__response_map_lock`")
-            return None
+            if not await self.transmit(client_request, self.replica):
+                logging.error(f'Failed to transmit {ClientRequest.Method.Name(client_request.method)}')
+                return None
+            return await self.collect(request_uuid, future, timeout if timeout is not None else self.response_timeout)
+        finally:
+            self.forget(request_uuid)
 
 
 class ObsidoResponseQueue(asyncio.Queue):
     def __init__(self):
         super().__init__()
+        self.arrived = asyncio.Event()
+
+    def _put(self, item):
+        super()._put(item)
+        self.arrived.set()
+
+    async def wait_for_epoch(self, epoch_id: int):
+        """Wait until a queued response closes `epoch_id` or a later one, without taking it off the queue."""
+        while not any(resp.r_last_epoch_id >= epoch_id for resp in self._queue):
+            self.arrived.clear()
+            await self.arrived.wait()
 
     async def drain(self) -> WeightsResponse:
         fetch_resp: WeightsResponse = await self.get()
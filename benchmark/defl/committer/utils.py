@@ -1,11 +1,18 @@
+import asyncio
 import logging
-from socket import socket
-from asyncio import StreamReader, StreamWriter
+import time
+from collections import deque
+from asyncio import IncompleteReadError, Queue, StreamReader, StreamWriter
+from typing import Awaitable, Callable, Deque, Optional, Tuple
+
+# as in the node's receivers
+MAX_FRAME_LENGTH = 8 * 1024 * 1024 * 1024
 
 
 class LengthDelimitedCodec:
-    def __init__(self, length_field_length: int):
+    def __init__(self, length_field_length: int, max_frame_length: int = MAX_FRAME_LENGTH):
         self.length_field_length = length_field_length
+        self.max_frame_length = max_frame_length
 
     # def length_delimited_send(self, sock: socket, data: bytes):
     #     length = len(data)
@@ -17,9 +24,25 @@ class LengthDelimitedCodec:
     #     payload = sock.recv(length)
     #     return payload
 
-    async def async_length_delimited_recv(self, reader: StreamReader):
-        length_bytes = await reader.readexactly(self.length_field_length)
+    def decode_length(self, length_bytes) -> int:
         length = int.from_bytes(length_bytes, byteorder='big', signed=False)
+        if length > self.max_frame_length:
+            raise ValueError(f'Frame of {length} bytes exceeds the limit of {self.max_frame_length} bytes')
+        return length
+
+    def encode_length(self, length: int) -> bytes:
+        if length > self.max_frame_length:
+            raise ValueError(f'Frame of {length} bytes exceeds the limit of {self.max_frame_length} bytes')
+        return length.to_bytes(self.length_field_length, byteorder='big', signed=False)
+
+    @staticmethod
+    def report(action: str, length: int, begin: float, level: int = logging.DEBUG):
+        elapsed = time.perf_counter() - begin
+        logging.log(level, f'{action} {length} bytes in {elapsed:.3f}s ({length / max(elapsed, 1e-9) / 2 ** 20:.1f} MiB/s)')
+
+    async def async_length_delimited_recv(self, reader: StreamReader):
+        """Only used for the replica's "Ack <uuid>" frames; responses and weights arrive through FrameProtocol."""
+        length = self.decode_length(await reader.readexactly(self.length_field_length))
         logging.debug(f'Ought to receive {length} bytes')
         payload = await reader.readexactly(length)
         return payload
@@ -27,5 +50,179 @@ class LengthDelimitedCodec:
     async def async_length_delimited_send(self, writer: StreamWriter, data: bytes):
         length = len(data)
         logging.debug(f'Ought to send {length} bytes')
-        writer.write(length.to_bytes(self.length_field_length, byteorder='big', signed=False) + data)
+        begin = time.perf_counter()
+        # separate writes rather than header + data, which would copy the whole payload; the transport sends
+        # straight from `data` and only buffers what the socket does not take right away
+        writer.write(self.encode_length(length))
+        writer.write(data)
         await writer.drain()
+        self.report('Sent', length, begin)
+
+
+class FrameProtocol(asyncio.BufferedProtocol):
+    """
+    Receives length-delimited frames from the socket straight into one reusable bytearray, without the copies a
+    StreamReader makes. Each frame goes to `handle` as a memoryview that stays valid until the awaitable it returns
+    is done, the socket is not read in the meantime.
+    """
+
+    def __init__(self, handle: Callable[[memoryview], Awaitable], codec: LengthDelimitedCodec, name: str):
+        self.handle = handle
+        self.codec = codec
+        self.name = name
+        self.transport: Optional[asyncio.Transport] = None
+        self.header = bytearray(codec.length_field_length)
+        self.buffer = bytearray()
+        # length of the frame being read, None while reading its header
+        self.length: Optional[int] = None
+        self.filled = 0
+        self.begin = 0.0
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+
+    def connection_lost(self, exc: Optional[Exception]):
+        if exc is not None:
+            logging.warning(f'{self.name} connection lost: {exc}')
+        elif self.length is not None or self.filled > 0:
+            logging.warning(f'{self.name} Incomplete read, closing...')
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        if self.length is None:
+            return memoryview(self.header)[self.filled:]
+        return memoryview(self.buffer)[self.filled:self.length]
+
+    def buffer_updated(self, nbytes: int):
+        if self.length is None and self.filled == 0:
+            self.begin = time.perf_counter()
+        self.filled += nbytes
+        if self.length is None:
+            if self.filled < len(self.header):
+                return
+            try:
+                self.length = self.codec.decode_length(self.header)
+            except ValueError as e:
+                logging.error(f'{self.name} {e}, closing...')
+                self.filled = 0
+                self.transport.close()
+                return
+            self.filled = 0
+            if len(self.buffer) < self.length:
+                # grows to the largest frame seen, as the weights are about the same size every epoch
+                self.buffer = bytearray(self.length)
+        if self.filled < self.length:
+            return
+        self.codec.report(f'{self.name} Received', self.length, self.begin, logging.INFO)
+        frame = memoryview(self.buffer)[:self.length]
+        self.length, self.filled = None, 0
+        self.transport.pause_reading()
+        asyncio.ensure_future(self.handle(frame)).add_done_callback(self._handled)
+
+    def _handled(self, task: asyncio.Future):
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f'{self.name} Failed to handle a frame: {task.exception()!r}, closing...')
+            self.transport.close()
+        elif not self.transport.is_closing():
+            self.transport.resume_reading()
+
+
+class PipelinedChannel:
+    """
+    A request/ack connection to the node with up to `window` requests in flight. One writer task puts frames on
+    the wire in submission order, and the node acks them in the same order as "Ack <request_uuid>". Requests
+    queued while the connection is down are sent once it is re-established, unacked ones fail. With `path`, the
+    connection is to that Unix domain socket instead of host:port.
+    """
+
+    def __init__(self, host: str, port: int, codec: LengthDelimitedCodec, window: int = 16,
+                 path: Optional[str] = None):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.codec = codec
+        self.window = asyncio.Semaphore(window)
+        self.connected = asyncio.Event()
+        self.outbox: Queue = Queue()
+        self.in_flight: Deque[Tuple[str, asyncio.Future]] = deque()
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def address(self) -> str:
+        return self.path if self.path is not None else '{}:{}'.format(self.host, self.port)
+
+    def open(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def close(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        while not self.outbox.empty():
+            self._fail(self.outbox.get_nowait()[1:], ConnectionAbortedError('channel closed'))
+
+    async def request(self, request_id: str, data: bytes) -> bool:
+        """Whether the node acked the request."""
+        await self.window.acquire()
+        future = asyncio.get_running_loop().create_future()
+        self.outbox.put_nowait((data, request_id, future))
+        return await future
+
+    def _fail(self, entry: Tuple[str, asyncio.Future], error: Exception):
+        self.window.release()
+        if not entry[1].done():
+            entry[1].set_exception(error)
+
+    async def _run(self):
+        while True:
+            try:
+                if self.path is not None:
+                    reader, writer = await asyncio.open_unix_connection(self.path)
+                else:
+                    reader, writer = await asyncio.open_connection(self.host, self.port)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # the node may not have created its socket yet
+                logging.warning('Connection refused, retrying...')
+                await asyncio.sleep(0.1)
+                continue
+            self.connected.set()
+            tasks = [asyncio.create_task(self._write_loop(writer)), asyncio.create_task(self._read_loop(reader))]
+            try:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                self.connected.clear()
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                writer.close()
+                error = ConnectionResetError('Connection to {} lost'.format(self.address))
+                while self.in_flight:
+                    self._fail(self.in_flight.popleft(), error)
+            logging.warning('%s, reconnecting...', next(iter(done)).exception() or error)
+
+    async def _write_loop(self, writer: StreamWriter):
+        while True:
+            data, request_id, future = await self.outbox.get()
+            if future.cancelled():
+                self.window.release()
+                continue
+            self.in_flight.append((request_id, future))
+            await self.codec.async_length_delimited_send(writer, data)
+
+    async def _read_loop(self, reader: StreamReader):
+        while True:
+            try:
+                ack = (await self.codec.async_length_delimited_recv(reader)).decode()
+            except IncompleteReadError:
+                return
+            if not self.in_flight:
+                logging.warning(f'Unexpected ack: {ack}')
+                continue
+            request_id, future = self.in_flight.popleft()
+            self.window.release()
+            status, _, ack_id = ack.partition(' ')
+            if status == 'Ack' and ack_id != request_id:
+                logging.error(f'Ack for {ack_id} received while expecting {request_id}')
+            if not future.done():
+                future.set_result(status == 'Ack' and ack_id == request_id)
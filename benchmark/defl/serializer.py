@@ -0,0 +1,331 @@
+import functools
+import io
+import logging
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple
+
+import h5py
+import numpy as np
+
+from defl.types import CODEC_TYPE
+
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Wire format, all integers little endian:
+#   header      magic 'DEFL' | u8 version | u8 codec id | u16 flags | u32 number of arrays | i64 base epoch id
+#   descriptors per array: 4s dtype str | u8 ndim | ndim x u64 dims | u64 offset | u64 nbytes
+#   body        the arrays, each starting on an ALIGNMENT boundary of the payload
+# Compressing codecs store every array as its own frame (nbytes is then the frame size), so frames are
+# compressed and decompressed independently on a thread pool. Quantizing codecs store every array as
+# f32 minimum | f32 scale | packed unsigned levels, and the sparse codec stores the non-zero entries of every
+# array as k x u32 flat indices | k values.
+# With FLAG_DELTA the arrays are deltas against the aggregated model of the base epoch.
+# HDF5 payloads carry no header and are recognised by their own signature.
+WIRE_MAGIC = b'DEFL'
+WIRE_VERSION = 2
+HDF5_SIGNATURE = b'\x89HDF\r\n\x1a\n'
+ALIGNMENT = 64
+
+CODEC_HDF5 = 0
+CODEC_RAW = 1
+CODEC_LZ4 = 2
+CODEC_ZSTD = 3
+CODEC_Q8 = 4
+CODEC_Q4 = 5
+CODEC_TOPK = 6
+CODEC_IDS = {'hdf5': CODEC_HDF5, 'raw': CODEC_RAW, 'lz4': CODEC_LZ4, 'zstd': CODEC_ZSTD, 'q8': CODEC_Q8, 'q4': CODEC_Q4,
+             'topk': CODEC_TOPK}
+QUANTIZATION_BITS = {CODEC_Q8: 8, CODEC_Q4: 4}
+QUANTIZED_CODECS = ('q8', 'q4')
+
+# the bytes of every element were transposed (byte-shuffled) before compression
+FLAG_SHUFFLE = 0x0001
+# the arrays are deltas against the aggregate of the header's base epoch
+FLAG_DELTA = 0x0002
+
+_HEADER = struct.Struct('<4sBBHIq')
+_DTYPE = struct.Struct('<4sB')
+_SPAN = struct.Struct('<QQ')
+_QUANTIZATION = struct.Struct('<ff')
+
+
+def _align(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+@functools.lru_cache(maxsize=None)
+def _get_executor(threads: int) -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(threads, thread_name_prefix='codec')
+
+
+def _map(func: Callable, items: list, threads: int) -> list:
+    if threads <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    return list(_get_executor(threads).map(func, items))
+
+
+def _shuffle(x: np.ndarray) -> np.ndarray:
+    """Group the i-th byte of every element together, so float exponents end up next to each other."""
+    return x.reshape(-1).view(np.uint8).reshape(-1, x.dtype.itemsize).T.copy()
+
+
+def _unshuffle(data: bytes, dtype: np.dtype) -> np.ndarray:
+    return np.frombuffer(data, dtype=np.uint8).reshape(dtype.itemsize, -1).T.copy().view(dtype).reshape(-1)
+
+
+def _quantize(x: np.ndarray, bits: int, rng: np.random.Generator) -> bytes:
+    """Per-array min/scale quantization to `bits` with stochastic rounding, which keeps it unbiased."""
+    x = x.reshape(-1).astype(np.float32, copy=False)
+    levels = (1 << bits) - 1
+    minimum = float(x.min()) if x.size else 0.0
+    scale = (float(x.max()) - minimum) / levels if x.size else 0.0
+    scale = scale if scale > 0 else 1.0
+    q = (x - np.float32(minimum)) / np.float32(scale)
+    q += rng.random(q.shape, dtype=np.float32)
+    q = np.clip(np.floor(q, out=q), 0, levels).astype(np.uint8)
+    if bits == 4:
+        q = np.append(q, np.uint8(0)) if q.size % 2 else q
+        q = q[0::2] | (q[1::2] << 4)
+    return _QUANTIZATION.pack(minimum, scale) + q.tobytes()
+
+
+def _dequantize_into(frame: memoryview, bits: int, out: np.ndarray):
+    minimum, scale = _QUANTIZATION.unpack_from(frame)
+    q = np.frombuffer(frame, dtype=np.uint8, offset=_QUANTIZATION.size)
+    if bits == 4:
+        unpacked = np.empty(2 * q.size, dtype=np.uint8)
+        np.bitwise_and(q, 0x0F, out=unpacked[0::2])
+        np.right_shift(q, 4, out=unpacked[1::2])
+        q = unpacked[:out.size]
+    flat = out.reshape(-1)
+    np.multiply(q, np.float32(scale), out=flat, casting='unsafe')
+    flat += np.float32(minimum)
+
+
+def _sparsify(x: np.ndarray) -> bytes:
+    flat = x.reshape(-1)
+    indices = np.flatnonzero(flat).astype(np.uint32)
+    return indices.tobytes() + flat[indices].tobytes()
+
+
+def _read_sparse(frame: memoryview, dtype: np.dtype) -> Tuple[np.ndarray, np.ndarray]:
+    k = len(frame) // (4 + dtype.itemsize)
+    indices = np.frombuffer(frame, dtype=np.uint32, count=k)
+    return indices, np.frombuffer(frame, dtype=dtype, count=k, offset=4 * k)
+
+
+def _compressor(codec_id: int, level: Optional[int]) -> Callable[[bytes], bytes]:
+    if codec_id == CODEC_LZ4:
+        if lz4 is None:
+            raise ValueError("Codec lz4 requires the `lz4` package")
+        if level is None:
+            return functools.partial(lz4.block.compress, store_size=True)
+        return functools.partial(lz4.block.compress, mode='high_compression', compression=level, store_size=True)
+    if codec_id == CODEC_ZSTD:
+        if zstandard is None:
+            raise ValueError("Codec zstd requires the `zstandard` package")
+        # ZstdCompressor objects must not be shared between threads
+        return lambda data: zstandard.ZstdCompressor(level=3 if level is None else level).compress(data)
+    raise ValueError("Codec id {} does not compress".format(codec_id))
+
+
+def _decompressor(codec_id: int) -> Callable[[bytes], bytes]:
+    if codec_id == CODEC_LZ4:
+        if lz4 is None:
+            raise ValueError("Codec lz4 requires the `lz4` package")
+        return lz4.block.decompress
+    if codec_id == CODEC_ZSTD:
+        if zstandard is None:
+            raise ValueError("Codec zstd requires the `zstandard` package")
+        return lambda data: zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError("Unknown codec id {}".format(codec_id))
+
+
+def _serialize_hdf5(arr_list: List[np.ndarray]) -> bytes:
+    with io.BytesIO() as bytes_file:
+        with h5py.File(bytes_file, 'w') as h5_file:
+            h5_file.attrs['length'] = len(arr_list)
+            for i, x in enumerate(arr_list):
+                h5_file.create_dataset(f'weight_{i:03d}', data=x, compression='gzip')
+        payload = bytes_file.getvalue()
+    return payload
+
+
+def _deserialize_hdf5(weights_bytes: bytes) -> List[np.ndarray]:
+    with io.BytesIO(weights_bytes) as bytes_file:
+        with h5py.File(bytes_file, 'r') as h5_file:
+            arr_list = [h5_file[f'weight_{i:03d}'][:] for i in range(h5_file.attrs['length'])]
+    return arr_list
+
+
+def _serialize_wire(arr_list: List[np.ndarray], codec_id: int, shuffle: bool, level: Optional[int],
+                    threads: int, base_epoch_id: Optional[int], rng: Optional[np.random.Generator]) -> bytes:
+    arr_list = [np.asarray(x, order='C') for x in arr_list]
+    if codec_id == CODEC_RAW:
+        frames = [memoryview(x.reshape(-1)).cast('B') for x in arr_list]
+    elif codec_id in QUANTIZATION_BITS:
+        rng = np.random.default_rng() if rng is None else rng
+        # one child generator per array keeps the threads off a shared generator
+        generators = [np.random.default_rng(seed) for seed in rng.integers(0, 1 << 63, len(arr_list))]
+        frames = _map(lambda item: _quantize(item[0], QUANTIZATION_BITS[codec_id], item[1]),
+                      list(zip(arr_list, generators)), threads)
+    elif codec_id == CODEC_TOPK:
+        frames = _map(_sparsify, arr_list, threads)
+    else:
+        compress = _compressor(codec_id, level)
+        frames = _map(lambda x: compress(_shuffle(x) if shuffle else x), arr_list, threads)
+    flags = FLAG_SHUFFLE if shuffle and codec_id in (CODEC_LZ4, CODEC_ZSTD) else 0
+    flags |= FLAG_DELTA if base_epoch_id is not None else 0
+
+    end = _HEADER.size + sum(_DTYPE.size + 8 * x.ndim + _SPAN.size for x in arr_list)
+    header = [_HEADER.pack(WIRE_MAGIC, WIRE_VERSION, codec_id, flags, len(arr_list), base_epoch_id or 0)]
+    body = []
+    for x, frame in zip(arr_list, frames):
+        offset = _align(end)
+        header += [_DTYPE.pack(x.dtype.str.encode(), x.ndim), struct.pack(f'<{x.ndim}Q', *x.shape),
+                   _SPAN.pack(offset, len(frame))]
+        body += [b'\0' * (offset - end), frame]
+        end = offset + len(frame)
+    # join copies every frame exactly once, straight into the payload
+    return b''.join(header + body)
+
+
+def _read_header(payload: bytes) -> Tuple[int, int, Optional[int], list]:
+    magic, version, codec_id, flags, count, base_epoch_id = _HEADER.unpack_from(payload)
+    if magic != WIRE_MAGIC:
+        raise ValueError("Unknown payload format")
+    if version != WIRE_VERSION:
+        raise ValueError("Unsupported wire format version {}".format(version))
+    descriptors = []
+    position = _HEADER.size
+    for _ in range(count):
+        dtype, ndim = _DTYPE.unpack_from(payload, position)
+        position += _DTYPE.size
+        shape = struct.unpack_from(f'<{ndim}Q', payload, position)
+        position += 8 * ndim
+        offset, nbytes = _SPAN.unpack_from(payload, position)
+        position += _SPAN.size
+        descriptors.append((np.dtype(dtype.rstrip(b'\0').decode()), shape, offset, nbytes))
+    logging.debug(f'Decoding {count} arrays with codec id {codec_id}, flags {flags:#06x}, base epoch {base_epoch_id}')
+    return codec_id, flags, base_epoch_id if flags & FLAG_DELTA else None, descriptors
+
+
+def _decode_array(payload: bytes, codec_id: int, flags: int, descriptor) -> np.ndarray:
+    dtype, shape, offset, nbytes = descriptor
+    if codec_id == CODEC_RAW:
+        return np.frombuffer(payload, dtype=dtype, count=nbytes // dtype.itemsize, offset=offset).reshape(shape)
+    frame = memoryview(payload)[offset:offset + nbytes]
+    if codec_id in QUANTIZATION_BITS:
+        out = np.empty(shape, dtype=np.float32)
+        _dequantize_into(frame, QUANTIZATION_BITS[codec_id], out)
+        return out
+    if codec_id == CODEC_TOPK:
+        out = np.zeros(shape, dtype=dtype)
+        indices, values = _read_sparse(frame, dtype)
+        out.reshape(-1)[indices] = values
+        return out
+    data = _decompressor(codec_id)(frame)
+    if flags & FLAG_SHUFFLE:
+        return _unshuffle(data, dtype).reshape(shape)
+    return np.frombuffer(data, dtype=dtype).reshape(shape)
+
+
+def serialize(arr_list: List[np.ndarray], codec: CODEC_TYPE = 'raw', shuffle: bool = True,
+              level: Optional[int] = None, threads: int = 1, base_epoch_id: Optional[int] = None,
+              rng: Optional[np.random.Generator] = None) -> bytes:
+    """`base_epoch_id` tags the arrays as deltas against that epoch's aggregate; HDF5 cannot carry it."""
+    if codec == 'hdf5':
+        if base_epoch_id is not None:
+            raise ValueError("Codec hdf5 cannot carry deltas")
+        return _serialize_hdf5(arr_list)
+    elif codec in CODEC_IDS:
+        return _serialize_wire(arr_list, CODEC_IDS[codec], shuffle, level, threads, base_epoch_id, rng)
+    else:
+        raise ValueError("Unknown codec {}".format(codec))
+
+
+def read_codec_id(payload: bytes) -> int:
+    if payload[:len(HDF5_SIGNATURE)] == HDF5_SIGNATURE:
+        return CODEC_HDF5
+    return _HEADER.unpack_from(payload)[2]
+
+
+def read_base_epoch_id(payload: bytes) -> Optional[int]:
+    """The epoch whose aggregate a delta payload is relative to, None for absolute weights."""
+    if payload[:len(HDF5_SIGNATURE)] == HDF5_SIGNATURE:
+        return None
+    _, _, _, flags, _, base_epoch_id = _HEADER.unpack_from(payload)
+    return base_epoch_id if flags & FLAG_DELTA else None
+
+
+def deserialize(payload: bytes, threads: int = 1) -> List[np.ndarray]:
+    """
+    Decode a payload of any codec, whatever codec the receiver itself sends with.
+    Uncompressed arrays are read-only views into `payload`, not copies.
+    """
+    if payload[:len(HDF5_SIGNATURE)] == HDF5_SIGNATURE:
+        return _deserialize_hdf5(payload)
+    codec_id, flags, _, descriptors = _read_header(payload)
+    return _map(lambda descriptor: _decode_array(payload, codec_id, flags, descriptor), descriptors, threads)
+
+
+def deserialize_into(payload: bytes, out: List[np.ndarray], threads: int = 1) -> Optional[int]:
+    """
+    Decode a payload straight into the arrays `out` (e.g. an aggregator row). Quantized arrays are dequantized
+    and sparse ones densified in place. Returns the payload's base epoch id.
+    """
+    if payload[:len(HDF5_SIGNATURE)] == HDF5_SIGNATURE:
+        codec_id, flags, base_epoch_id = CODEC_HDF5, 0, None
+        arrays = _deserialize_hdf5(payload)
+        descriptors = [(x.dtype, x.shape, 0, x.nbytes) for x in arrays]
+    else:
+        codec_id, flags, base_epoch_id, descriptors = _read_header(payload)
+    if [tuple(descriptor[1]) for descriptor in descriptors] != [np.shape(x) for x in out]:
+        raise ValueError("Payload does not match the expected layer shapes")
+
+    def decode(i: int):
+        if codec_id == CODEC_HDF5:
+            out[i][...] = arrays[i]
+        elif codec_id in QUANTIZATION_BITS:
+            offset, nbytes = descriptors[i][2:]
+            _dequantize_into(memoryview(payload)[offset:offset + nbytes], QUANTIZATION_BITS[codec_id], out[i])
+        elif codec_id == CODEC_TOPK:
+            dtype, _, offset, nbytes = descriptors[i]
+            indices, values = _read_sparse(memoryview(payload)[offset:offset + nbytes], dtype)
+            out[i][...] = 0
+            out[i].flat[indices] += values
+        else:
+            out[i][...] = _decode_array(payload, codec_id, flags, descriptors[i])
+
+    _map(decode, list(range(len(out))), threads)
+    return base_epoch_id
+
+
+def deserialize_sparse(payload: bytes, shapes: List[Tuple[int, ...]]) \
+        -> Tuple[List[Tuple[np.ndarray, np.ndarray]], Optional[int]]:
+    """
+    The (flat indices, values) of every array of a sparse payload, as views into it, and its base epoch id.
+    The arrays must have the layer `shapes`, and the indices are checked against them.
+    """
+    codec_id, flags, base_epoch_id, descriptors = _read_header(payload)
+    if codec_id != CODEC_TOPK:
+        raise ValueError("Codec id {} is not sparse".format(codec_id))
+    if [tuple(descriptor[1]) for descriptor in descriptors] != [tuple(shape) for shape in shapes]:
+        raise ValueError("Payload does not match the expected layer shapes")
+    view = memoryview(payload)
+    sparse = []
+    for dtype, shape, offset, nbytes in descriptors:
+        indices, values = _read_sparse(view[offset:offset + nbytes], dtype)
+        if len(indices) > 0 and int(indices.max()) >= int(np.prod(shape)):
+            raise ValueError("Sparse index out of range")
+        sparse.append((indices, values))
+    return sparse, base_epoch_id
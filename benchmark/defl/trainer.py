@@ -1,43 +1,85 @@
-import io
+import asyncio
+import functools
+import hashlib
 import logging
-from typing import Dict, List, Type
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type
 
-import h5py
 import numpy as np
 import tensorflow as tf
 
-from defl.aggregator import AbstractAggregator
+from defl.aggregator import AbstractAggregator, apply_delta
 from defl.dataloader.dataloader import DataLoader
+from defl.serializer import CODEC_HDF5, CODEC_TOPK, CODEC_TYPE, QUANTIZED_CODECS, deserialize_into, deserialize_sparse, \
+    read_base_epoch_id, read_codec_id, serialize
 
 
 # from defl.weightpoisoner import WeightPoisoner
 
-def _serialize_numpy_array_list(arr_list: List[np.ndarray]) -> bytes:
-    with io.BytesIO() as bytes_file:
-        with h5py.File(bytes_file, 'w') as h5_file:
-            h5_file.attrs['length'] = len(arr_list)
-            for i, x in enumerate(arr_list):
-                h5_file.create_dataset(f'weight_{i:03d}', data=x, compression='gzip')
-        payload = bytes_file.getvalue()
-    return payload
-
-
 def _get_trainable_weights(model: tf.keras.Model) -> List[np.ndarray]:
     lst = [x.numpy() for x in model.trainable_weights]
     return lst
 
 
-def _deserialize_numpy_array_list(weights_bytes: bytes) -> List[np.ndarray]:
-    with io.BytesIO(weights_bytes) as bytes_file:
-        with h5py.File(bytes_file, 'r') as h5_file:
-            arr_list = [h5_file[f'weight_{i:03d}'][:] for i in range(h5_file.attrs['length'])]
-    return arr_list
-
-
 def _set_trainable_weights(model: tf.keras.Model, arr_list: List[np.ndarray]) -> None:
     tf.keras.backend.batch_set_value(zip(model.trainable_weights, arr_list))
 
 
+def _optimizer_variables(model: tf.keras.Model) -> List[tf.Variable]:
+    # a method on the legacy optimizers, a property on the new ones
+    variables = model.optimizer.variables
+    return variables() if callable(variables) else variables
+
+
+def _build_optimizer(model: tf.keras.Model) -> None:
+    # slots are created lazily on the first update, but restoring them needs them now
+    optimizer = model.optimizer
+    if hasattr(optimizer, 'build'):
+        optimizer.build(model.trainable_variables)
+    else:
+        optimizer._create_all_weights(model.trainable_variables)
+
+
+def _digest(payload: bytes) -> bytes:
+    return hashlib.blake2b(payload, digest_size=16).digest()
+
+
+def _sparsify_top_k(arr_list: List[np.ndarray], ratio: float, threshold: Optional[float]) -> List[np.ndarray]:
+    """Zero all but the largest-magnitude coordinates, chosen across all layers by `threshold` or `ratio`."""
+    if threshold is None:
+        magnitudes = np.concatenate([np.abs(x).reshape(-1) for x in arr_list])
+        kth = magnitudes.size - max(1, int(ratio * magnitudes.size))
+        threshold = np.partition(magnitudes, kth)[kth]
+    return [np.where(np.abs(x) >= threshold, x, 0).astype(x.dtype) for x in arr_list]
+
+
+class BackgroundEvaluator:
+    """Evaluates snapshots of the aggregated weights on a replica of the model, on its own thread."""
+
+    def __init__(self, model: tf.keras.Model, dataloader: DataLoader, test_data, steps: Optional[int] = None):
+        self.replica: tf.keras.Model = tf.keras.models.clone_model(model)
+        dataloader.compile(self.replica)
+        self.test_data = test_data
+        self.steps = steps
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix='evaluator')
+        self.pending: Optional[Future] = None
+
+    async def evaluate(self, epoch_id: int, weights: List[np.ndarray]) -> List:
+        """Evaluate and log `weights` (all of the model's); an older snapshot still waiting is skipped."""
+        if self.pending is not None and self.pending.cancel():
+            logging.info("Skipped evaluating an older aggregate.")
+        self.pending = self.executor.submit(self._evaluate, epoch_id, weights)
+        return await asyncio.wrap_future(self.pending)
+
+    def _evaluate(self, epoch_id: int, weights: List[np.ndarray]) -> List:
+        self.replica.set_weights(weights)
+        score = self.replica.evaluate(self.test_data, steps=self.steps, verbose=0)
+        logging.info('[AGGREGATED] epoch_id: %d, metric_names: %s, metric_values: %s',
+                     epoch_id, str(self.replica.metrics_names), str(score))
+        return score
+
+
 class Trainer:
     def __init__(self,
                  model: tf.keras.Model,
@@ -46,7 +88,19 @@ class Trainer:
                  local_train_steps: int,
                  aggregator: AbstractAggregator,
                  num_byzantine: int,
-                 dataloader: DataLoader):
+                 dataloader: DataLoader,
+                 codec: CODEC_TYPE = 'raw',
+                 codec_level: Optional[int] = None,
+                 codec_shuffle: bool = True,
+                 codec_threads: int = 1,
+                 topk_ratio: float = 0.01,
+                 topk_threshold: Optional[float] = None,
+                 upload_delta: bool = False,
+                 decode_cache_size: int = 0,
+                 decode_workers: int = 1,
+                 eval_steps: Optional[int] = None,
+                 eval_every: int = 1,
+                 background_eval: bool = False):
 
         self.model: tf.keras.Model = model
         self.local_train_steps: int = local_train_steps
@@ -55,28 +109,263 @@ class Trainer:
         self.agg: AbstractAggregator = aggregator
         self.num_byzantine: int = num_byzantine
         self.dataloader = dataloader
+        self.codec: CODEC_TYPE = codec
+        self.codec_level: Optional[int] = codec_level
+        self.codec_shuffle: bool = codec_shuffle
+        self.codec_threads: int = codec_threads
+        self.topk_ratio: float = topk_ratio
+        self.topk_threshold: Optional[float] = topk_threshold
+        # quantized and sparse uploads are only meaningful as deltas
+        self.upload_delta: bool = upload_delta or codec in QUANTIZED_CODECS or codec == 'topk'
+        if self.upload_delta and codec == 'hdf5':
+            raise ValueError("The hdf5 codec cannot carry delta uploads")
 
         self.dataloader.compile(self.model)
         self.metric_names = self.model.metrics_names
         self.init_trainable_weights: List[np.ndarray] = _get_trainable_weights(self.model)
+        # the aggregate local training started from, which uploads and aggregation are deltas against
+        self.base_weights: List[np.ndarray] = self.init_trainable_weights
+        self.base_epoch_id: Optional[int] = None
+        self.rng = np.random.default_rng()
+        # error feedback: the part of the top-k delta not sent yet, carried into the next upload
+        self.residual: Optional[List[np.ndarray]] = None
+        # the residual of the last upload, which only replaces `residual` once the node accepted it
+        self.pending_residual: Optional[List[np.ndarray]] = None
+        # our last lossless upload as (digest, arrays), which comes back in the next WeightsResponse
+        self.own_upload: Optional[Tuple[bytes, List[np.ndarray]]] = None
+        # opt-in: up to `decode_cache_size` decoded client updates keyed by payload digest, least recently used
+        # first; every entry is a full copy of a row
+        self.decode_cache_size: int = decode_cache_size
+        self.decoded: 'OrderedDict[bytes, List[np.ndarray]]' = OrderedDict()
+        # clients are decoded concurrently into their rows; the codecs and NumPy release the GIL
+        self.decode_executor: Optional[ThreadPoolExecutor] = \
+            ThreadPoolExecutor(decode_workers, thread_name_prefix='decoder') if decode_workers > 1 else None
+        self.eval_steps: Optional[int] = eval_steps
+        self.eval_every: int = eval_every
+        self.evaluator: Optional[BackgroundEvaluator] = \
+            BackgroundEvaluator(self.model, self.dataloader, test_data, eval_steps) if background_eval else None
+        # the heavy calls run one at a time on this thread, keeping the event loop free for network I/O
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix='trainer')
+
+    def run(self, func: Callable, *args, **kwargs) -> 'asyncio.Future[Any]':
+        """Run `func` (e.g. self.local_train) on the trainer thread, awaitable from the event loop."""
+        return asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    def snapshot(self) -> Dict[str, Any]:
+        """The state a round changes, so that a speculative round can be rolled back with restore()."""
+        # all variables, BatchNorm moving statistics included; the aggregator keeps nothing between rounds
+        return {
+            'weights': self.model.get_weights(),
+            'optimizer': [v.numpy() for v in _optimizer_variables(self.model)],
+            'base_weights': self.base_weights,
+            'base_epoch_id': self.base_epoch_id,
+            'residual': self.residual,
+            'own_upload': self.own_upload,
+            'decoded': OrderedDict(self.decoded),
+        }
 
+    def restore(self, state: Dict[str, Any]):
+        self.model.set_weights(state['weights'])
+        # slots created after the snapshot keep their values
+        tf.keras.backend.batch_set_value(zip(_optimizer_variables(self.model), state['optimizer']))
+        self.base_weights = state['base_weights']
+        self.base_epoch_id = state['base_epoch_id']
+        self.residual = state['residual']
+        self.pending_residual = None
+        self.own_upload = state['own_upload']
+        self.decoded = state['decoded']
+
+    def checkpoint_state(self) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+        """All of the model's weights and the optimizer state, for a Checkpointer."""
+        return self.model.get_weights(), [v.numpy() for v in _optimizer_variables(self.model)]
+
+    def resume_state(self) -> List[List[np.ndarray]]:
+        """
+        All of the model's weights right after aggregating (the aggregate training starts from, plus e.g. BatchNorm
+        moving statistics), the optimizer state and the top-k residual, for resume().
+        """
+        return [self.model.get_weights(), [v.numpy() for v in _optimizer_variables(self.model)], self.residual or []]
+
+    def resume(self, base_epoch_id: int, weights: List[np.ndarray], optimizer: List[np.ndarray],
+               residual: List[np.ndarray]):
+        """
+        Continue from a resume_state() saved after aggregating `base_epoch_id`. If the node has moved on by more
+        than a round since, aggregate_weights() drops the base and uploads are absolute weights again.
+        """
+        self.model.set_weights(weights)
+        _build_optimizer(self.model)
+        variables = _optimizer_variables(self.model)
+        if len(variables) == len(optimizer):
+            tf.keras.backend.batch_set_value(zip(variables, optimizer))
+        else:
+            logging.warning(f"Optimizer has {len(variables)} variables but {len(optimizer)} were saved, not restoring it")
+        self.base_weights = _get_trainable_weights(self.model)
+        self.base_epoch_id = base_epoch_id
+        self.residual = [np.array(r) for r in residual] if residual else None
 
     def get_serialized_weights(self) -> bytes:
-        return _serialize_numpy_array_list(_get_trainable_weights(self.model))
+        weights = _get_trainable_weights(self.model)
+        codec, base_epoch_id = self.codec, None
+        if self.upload_delta and self.base_epoch_id is None:
+            # no base shared with the other clients (see aggregate_weights), so absolute weights, which quantizing
+            # or sparsifying would wreck
+            if codec in QUANTIZED_CODECS or codec == 'topk':
+                codec = 'raw'
+        elif self.upload_delta:
+            weights = [w - b for w, b in zip(weights, self.base_weights)]
+            base_epoch_id = self.base_epoch_id
+        if codec == 'topk':
+            if self.residual is not None:
+                weights = [d + r for d, r in zip(weights, self.residual)]
+            sent = _sparsify_top_k(weights, self.topk_ratio, self.topk_threshold)
+            self.pending_residual = [d - w for d, w in zip(weights, sent)]
+            weights = sent
+        payload = serialize(weights, codec, shuffle=self.codec_shuffle, level=self.codec_level,
+                            threads=self.codec_threads, base_epoch_id=base_epoch_id, rng=self.rng)
+        # lossless uploads decode to exactly these arrays when our entry comes back
+        if codec not in QUANTIZED_CODECS and codec != 'topk':
+            self.own_upload = (_digest(payload), weights)
+        return payload
+
+    def commit_upload(self):
+        """The last get_serialized_weights() payload was accepted, so what it left out is carried forward."""
+        if self.pending_residual is not None:
+            self.residual, self.pending_residual = self.pending_residual, None
+
+    def _cache_decoded(self, digest: bytes, arr_list: Optional[List[np.ndarray]]):
+        if arr_list is None:
+            return
+        self.decoded[digest] = arr_list
+        while len(self.decoded) > self.decode_cache_size:
+            self.decoded.popitem(last=False)
+
+    def _to_delta(self, row: List[np.ndarray], base_epoch_id: Optional[int]):
+        # the aggregators work on deltas against the base; absolute weights are converted
+        if base_epoch_id is None:
+            for view, base in zip(row, self.base_weights):
+                view -= base
+
+    def _decode_into(self, row: List[np.ndarray], payload: bytes,
+                     base_epoch_id: Optional[int]) -> Optional[List[np.ndarray]]:
+        # decoded (and dequantized) straight into the aggregator's row; returns a copy if the cache is on
+        deserialize_into(payload, row, threads=self.codec_threads)
+        decoded = [view.copy() for view in row] if self.decode_cache_size > 0 else None
+        self._to_delta(row, base_epoch_id)
+        return decoded
+
+    def _add_client(self, shapes: List[tuple], payload: bytes, base_epoch_id: Optional[int]) -> Optional[bytes]:
+        """Add a sparse or already decoded client, otherwise return the digest of the payload to decode."""
+        if base_epoch_id is not None and read_codec_id(payload) == CODEC_TOPK:
+            # sparse arrays are views into the payload, nothing to cache
+            sparse, _ = deserialize_sparse(payload, shapes)
+            self.agg.add_sparse_client(shapes, sparse)
+            return None
+        digest = _digest(payload)
+        if self.own_upload is not None and self.own_upload[0] == digest:
+            cached = self.own_upload[1]
+        elif digest in self.decoded:
+            cached = self.decoded[digest]
+            self.decoded.move_to_end(digest)
+        else:
+            return digest
+        row = self.agg.next_client(shapes)
+        for view, arr in zip(row, cached):
+            view[...] = arr
+        self._to_delta(row, base_epoch_id)
+        self.agg.commit_client()
+        return None
+
+    def _try_decode_into(self, client_name: str, row: List[np.ndarray], payload: bytes,
+                         base_epoch_id: Optional[int]) -> Tuple[bool, Optional[List[np.ndarray]]]:
+        """_decode_into(), but a payload that fails to decode is logged and reported as (False, None)."""
+        try:
+            return True, self._decode_into(row, payload, base_epoch_id)
+        except Exception as e:
+            # whatever a faulty or Byzantine client sends must not stop the aggregation
+            logging.warning(f"Dropping [{client_name}]: {e!r}")
+            return False, None
+
+    def _decode_clients(self, shapes: List[tuple], pending: List[Tuple[str, bytes, bytes, Optional[int]]]):
+        """
+        Decode (client name, digest, payload, base epoch id) entries into the aggregator, concurrently when
+        possible. Clients that fail to decode are left out.
+        """
+        if self.decode_executor is None or not self.agg.concurrent_rows or len(pending) < 2:
+            for client_name, digest, payload, base_epoch_id in pending:
+                ok, decoded = self._try_decode_into(client_name, self.agg.next_client(shapes), payload, base_epoch_id)
+                if ok:
+                    self._cache_decoded(digest, decoded)
+                    self.agg.commit_client()
+            return
+        rows = self.agg.next_clients(shapes, len(pending))
+        # h5py serializes all calls anyway, so HDF5 blobs are decoded here while the pool works on the rest
+        futures = [None if read_codec_id(payload) == CODEC_HDF5 else
+                   self.decode_executor.submit(self._try_decode_into, client_name, row, payload, base_epoch_id)
+                   for row, (client_name, _, payload, base_epoch_id) in zip(rows, pending)]
+        results = [self._try_decode_into(client_name, row, payload, base_epoch_id) if future is None else None
+                   for future, row, (client_name, _, payload, base_epoch_id) in zip(futures, rows, pending)]
+        kept = 0
+        for i, (future, result, (_, digest, _, _)) in enumerate(zip(futures, results, pending)):
+            ok, decoded = result if future is None else future.result()
+            if not ok:
+                continue
+            # close the gaps failed clients left, the rows only count up to commit_clients()
+            if i != kept:
+                for view, source in zip(rows[kept], rows[i]):
+                    view[...] = source
+            self._cache_decoded(digest, decoded)
+            kept += 1
+        self.agg.commit_clients(kept)
 
-    def aggregate_weights(self, weights: Dict[str, bytes]):
+    def aggregate_weights(self, weights: Dict[str, bytes], epoch_id: int):
+        if self.base_epoch_id is not None and epoch_id > self.base_epoch_id + 1:
+            # resumed from an old checkpoint or missed rounds: the deltas of `epoch_id` are against a newer aggregate
+            logging.warning(f"The local base is epoch {self.base_epoch_id}, too old for the updates of epoch {epoch_id}")
+            self.base_epoch_id = None
+        skipped = 0
         if len(weights) == 0:
             _set_trainable_weights(self.model, self.init_trainable_weights)
             # self.model.set_weights(self.init_weights)
             logging.warning("No weights received, using initial weights!")
         else:
-            for client_name, client_weights_hdf5 in weights.items():
-                client_weights = _deserialize_numpy_array_list(client_weights_hdf5)
-                self.agg.add_client_weight(client_weight=client_weights)
-            w_agg = self.agg.aggregate(num_byzantine=self.num_byzantine)
-            # self.model.set_weights(w_agg)
-            _set_trainable_weights(self.model, w_agg)
-            self.agg.clear_aggregator()
+            shapes = [w.shape for w in self.base_weights]
+            self.agg.reserve(len(weights))
+            try:
+                pending = []
+                for client_name, client_weights_bytes in weights.items():
+                    try:
+                        base_epoch_id = read_base_epoch_id(client_weights_bytes)
+                        if base_epoch_id is not None and base_epoch_id != self.base_epoch_id:
+                            logging.warning(f"Skipping [{client_name}]: delta against epoch {base_epoch_id}, "
+                                            f"but the local base is epoch {self.base_epoch_id}")
+                            skipped += 1
+                            continue
+                        digest = self._add_client(shapes, client_weights_bytes, base_epoch_id)
+                    except Exception as e:
+                        logging.warning(f"Dropping [{client_name}]: {e!r}")
+                        continue
+                    if digest is not None:
+                        pending.append((client_name, digest, client_weights_bytes, base_epoch_id))
+                self._decode_clients(shapes, pending)
+                if self.agg.num_clients == 0:
+                    logging.warning("No usable weights received, keeping the base weights!")
+                    _set_trainable_weights(self.model, self.base_weights)
+                else:
+                    delta = self.agg.aggregate(num_byzantine=self.num_byzantine)
+                    # self.model.set_weights(w_agg)
+                    apply_delta(self.model, delta, base=self.base_weights)
+            finally:
+                self.agg.clear_aggregator()
+        # deltas against anything but the last aggregate are skipped by every client; without that aggregate
+        # we skipped updates the others used, and deltas against ours would be applied to theirs
+        in_sync = skipped == 0 or self.base_epoch_id == epoch_id - 1
+        self.base_weights = _get_trainable_weights(self.model)
+        self.base_epoch_id = epoch_id
+        if not in_sync:
+            logging.warning(f"Missing {skipped} updates of epoch {epoch_id}, uploading absolute weights "
+                            f"until a full round is aggregated")
+            self.base_epoch_id = None
+            self.residual, self.pending_residual = None, None
 
     def local_train(self, callbacks: List[tf.keras.callbacks.Callback]):
         # self.dataloader.compile(self.model)
@@ -88,4 +377,4 @@ class Trainer:
                        )
 
     def evaluate(self) -> List:
-        return self.model.evaluate(self.test_data, verbose=1)
+        return self.model.evaluate(self.test_data, steps=self.eval_steps, verbose=1)
@@ -10,7 +10,8 @@ DataConfig = TypedDict("DataConfig", {
 })
 
 ATTACK_METHOD = Literal['none', 'gaussian', 'sign', 'label']
-AGGREGATOR_TYPE = Literal['krum', 'multikrum', 'fedavg']
+CODEC_TYPE = Literal['hdf5', 'raw', 'lz4', 'zstd', 'q8', 'q4', 'topk']
+AGGREGATOR_TYPE = Literal['krum', 'multikrum', 'fedavg', 'median', 'trimmedmean', 'geomed', 'bulyan']
 
 ClientConfig = TypedDict('ClientConfig', {
     'aggregator': AGGREGATOR_TYPE,
@@ -20,20 +21,52 @@ ClientConfig = TypedDict('ClientConfig', {
     'local_train_steps': int,
     'env': dict,
     'save_freq': int,
+    'checkpoint_keep': Optional[int],
+    'checkpoint_keep_every': Optional[int],
+    'checkpoint_codec': Optional[CODEC_TYPE],
+    'state_dir': Optional[str],
+    'codec': Optional[CODEC_TYPE],
+    'codec_level': Optional[int],
+    'codec_shuffle': Optional[bool],
+    'codec_threads': Optional[int],
+    'topk_ratio': Optional[float],
+    'topk_threshold': Optional[float],
+    'upload_delta': Optional[bool],
+    'decode_cache_size': Optional[int],
+    'decode_workers': Optional[int],
+    'eval_steps': Optional[int],
+    'eval_every': Optional[int],
+    'background_eval': Optional[bool],
+    'fedavg_streaming': Optional[bool],
+    'aggregator_workers': Optional[int],
 
     # ----------------------------------------- #
     'task': str,
     'client_name': str,
     'server_name': str,
     'obsido_port': int,
+    'multiplexed': Optional[bool],
+    'max_in_flight': Optional[int],
+    'response_timeout': Optional[int],
+    'consensus_socket': Optional[str],
+    'obsido_socket': Optional[str],
+    'callback_socket': Optional[str],
     'host': str,
     'init_model_path': str,
     'fetch': int,
     'gst': int,
+    'speculative': Optional[bool],
+    'speculative_min_clients': Optional[int],
+    'speculative_poll': Optional[int],
 
     # ----------- byzantine config ------------ #
     'num_byzantine': int,
     'multikrum_factor': int,
+    'krum_sketch_dim': Optional[int],
+    'krum_sketch_seed': Optional[int],
+    'krum_sketch_exact_candidates': Optional[int],
+    'geomed_tol': Optional[float],
+    'geomed_max_iter': Optional[int],
     'gaussian_attack_factor': Optional[float],
     'signflip_attack_factor': Optional[float],
 })
@@ -1,4 +1,5 @@
 use std::error::Error;
+use std::path::PathBuf;
 
 use async_trait::async_trait;
 use bytes::Bytes;
@@ -57,6 +58,8 @@ pub struct Mempool {
     store: Store,
     /// Send messages to consensus.
     tx_consensus: Sender<Digest>,
+    /// Unix domain socket on which co-located clients may also send transactions.
+    transactions_socket: Option<PathBuf>,
 }
 
 impl Mempool {
@@ -67,6 +70,7 @@ impl Mempool {
         store: Store,
         rx_consensus: Receiver<ConsensusMempoolMessage>,
         tx_consensus: Sender<Digest>,
+        transactions_socket: Option<PathBuf>,
     ) {
         // NOTE: This log entry is used to compute performance.
         parameters.log();
@@ -78,6 +82,7 @@ impl Mempool {
             parameters,
             store,
             tx_consensus,
+            transactions_socket,
         };
 
         // Spawn all mempool tasks.
@@ -122,10 +127,12 @@ impl Mempool {
             .transactions_address(&self.name)
             .expect("Our public key is not in the committee");
         address.set_ip("127.0.0.1".parse().unwrap());
-        NetworkReceiver::spawn(
-            address,
-            /* handler */ TxReceiverHandler { tx_batch_maker },
-        );
+        let handler = TxReceiverHandler { tx_batch_maker };
+        if let Some(path) = &self.transactions_socket {
+            NetworkReceiver::spawn_unix(path.clone(), handler.clone());
+            info!("Mempool listening to client transactions on {}", path.display());
+        }
+        NetworkReceiver::spawn(address, handler);
 
         // TransactionFilter::spawn(rx_filter, tx_batch_maker);
 
@@ -209,17 +216,18 @@ struct TxReceiverHandler {
 impl MessageHandler for TxReceiverHandler {
     async fn dispatch(&self, writer: &mut Writer, message: Bytes) -> Result<(), Box<dyn Error>> {
 
+        // Acks name the request so that clients can pipeline requests on one connection.
         let imm_resp = match ClientRequest::decode(message.clone()) {
-            Ok(_) => {
+            Ok(request) => {
                 // Send the transaction to the batch maker.
                 self.tx_batch_maker
                     .send(message.to_vec())
                     .await
                     .expect("Failed to send transaction");
 
-                "Ack"
+                format!("Ack {}", request.request_uuid)
             },
-            Err(_) => "Invalid CLIENT Transaction"
+            Err(_) => "Invalid CLIENT Transaction".to_string()
         };
 
         info!("CLIENT HANDLER: Sending {} to client", &imm_resp);
@@ -30,6 +30,7 @@ async fn handle_clients_transactions() {
         store,
         rx_consensus_to_mempool,
         tx_mempool_to_consensus,
+        /* transactions_socket */ None,
     );
 
     // Spawn enough mempools' listeners to acknowledge our batches.
@@ -1,25 +1,26 @@
 // Copyright(C) Facebook, Inc. and its affiliates.
 use std::fmt::Debug;
-use std::net::SocketAddr;
 use thiserror::Error;
 
+use crate::transport::Address;
+
 #[derive(Error, Debug)]
 pub enum NetworkError {
     #[error("Failed to connect to {0} (retry {1}): {2}")]
-    FailedToConnect(SocketAddr, u16, std::io::Error),
+    FailedToConnect(Address, u16, std::io::Error),
 
     #[error("Failed to accept connection: {0}")]
     FailedToListen(std::io::Error),
 
     #[error("Failed to send message to {0}: {1}")]
-    FailedToSendMessage(SocketAddr, std::io::Error),
+    FailedToSendMessage(Address, std::io::Error),
 
     #[error("Failed to receive message from {0}: {1}")]
-    FailedToReceiveMessage(SocketAddr, std::io::Error),
+    FailedToReceiveMessage(Address, std::io::Error),
 
     #[error("Failed to receive ACK from {0}")]
-    FailedToReceiveAck(SocketAddr),
+    FailedToReceiveAck(Address),
 
     #[error("Receive unexpected ACK from {0}")]
-    UnexpectedAck(SocketAddr),
+    UnexpectedAck(Address),
 }
@@ -3,6 +3,7 @@ mod error;
 mod receiver;
 mod reliable_sender;
 mod simple_sender;
+mod transport;
 
 #[cfg(test)]
 #[path = "tests/common.rs"]
@@ -11,3 +12,4 @@ pub mod common;
 pub use crate::receiver::{MessageHandler, Receiver, Writer};
 pub use crate::reliable_sender::{CancelHandler, ReliableSender};
 pub use crate::simple_sender::SimpleSender;
+pub use crate::transport::{Address, Stream};
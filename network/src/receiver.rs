@@ -1,23 +1,25 @@
 use std::error::Error;
 use std::net::SocketAddr;
+use std::path::PathBuf;
 
 use async_trait::async_trait;
 use bytes::Bytes;
 use futures::stream::SplitSink;
 use futures::stream::StreamExt as _;
 use log::{debug, info, warn};
-use tokio::net::{TcpListener, TcpStream};
+use tokio::net::{TcpListener, UnixListener};
 use tokio_util::codec::{Framed, LengthDelimitedCodec};
 
 // Copyright(C) Facebook, Inc. and its affiliates.
 use crate::error::NetworkError;
+use crate::transport::{Address, Stream};
 
 #[cfg(test)]
 #[path = "tests/receiver_tests.rs"]
 pub mod receiver_tests;
 
-/// Convenient alias for the writer end of the TCP channel.
-pub type Writer = SplitSink<Framed<TcpStream, LengthDelimitedCodec>, Bytes>;
+/// Convenient alias for the writer end of the TCP (or Unix domain socket) channel.
+pub type Writer = SplitSink<Framed<Stream, LengthDelimitedCodec>, Bytes>;
 
 #[async_trait]
 pub trait MessageHandler: Clone + Send + Sync + 'static {
@@ -32,7 +34,7 @@ pub trait MessageHandler: Clone + Send + Sync + 'static {
 /// through the provided deliver channel.
 pub struct Receiver<Handler: MessageHandler> {
     /// Address to listen to.
-    address: SocketAddr,
+    address: Address,
     /// Struct responsible to define how to handle received messages.
     handler: Handler,
 }
@@ -41,33 +43,62 @@ impl<Handler: MessageHandler> Receiver<Handler> {
     /// Spawn a new network receiver handling connections from any incoming peer.
     pub fn spawn(address: SocketAddr, handler: Handler) {
         tokio::spawn(async move {
-            Self { address, handler }.run().await;
+            Self { address: Address::Tcp(address), handler }.run().await;
+        });
+    }
+
+    /// Spawn a new network receiver listening on a Unix domain socket, for peers on the same machine.
+    pub fn spawn_unix(path: PathBuf, handler: Handler) {
+        tokio::spawn(async move {
+            Self { address: Address::Unix(path), handler }.run().await;
         });
     }
 
     /// Main loop responsible to accept incoming connections and spawn a new runner to handle it.
     async fn run(&self) {
-        let listener = TcpListener::bind(&self.address)
-            .await
-            .expect("Failed to bind TCP port");
+        match &self.address {
+            Address::Tcp(address) => {
+                let listener = TcpListener::bind(address)
+                    .await
+                    .expect("Failed to bind TCP port");
+
+                debug!("Listening on {}", self.address);
+                loop {
+                    let (socket, peer) = match listener.accept().await {
+                        Ok(value) => value,
+                        Err(e) => {
+                            warn!("{}", NetworkError::FailedToListen(e));
+                            continue;
+                        }
+                    };
+                    info!("Incoming connection established with {}", peer);
+                    Self::spawn_runner(Stream::Tcp(socket), peer.into(), self.handler.clone()).await;
+                }
+            }
+            Address::Unix(path) => {
+                // A socket file left behind by a previous run would make the bind fail.
+                let _ = std::fs::remove_file(path);
+                let listener = UnixListener::bind(path).expect("Failed to bind Unix socket");
 
-        debug!("Listening on {}", self.address);
-        loop {
-            let (socket, peer) = match listener.accept().await {
-                Ok(value) => value,
-                Err(e) => {
-                    warn!("{}", NetworkError::FailedToListen(e));
-                    continue;
+                debug!("Listening on {}", self.address);
+                loop {
+                    let (socket, _) = match listener.accept().await {
+                        Ok(value) => value,
+                        Err(e) => {
+                            warn!("{}", NetworkError::FailedToListen(e));
+                            continue;
+                        }
+                    };
+                    info!("Incoming connection established on {}", self.address);
+                    Self::spawn_runner(Stream::Unix(socket), self.address.clone(), self.handler.clone()).await;
                 }
-            };
-            info!("Incoming connection established with {}", peer);
-            Self::spawn_runner(socket, peer, self.handler.clone()).await;
+            }
         }
     }
 
-    /// Spawn a new runner to handle a specific TCP connection. It receives messages and process them
+    /// Spawn a new runner to handle a specific connection. It receives messages and process them
     /// using the provided handler.
-    async fn spawn_runner(socket: TcpStream, peer: SocketAddr, handler: Handler) {
+    async fn spawn_runner(socket: Stream, peer: Address, handler: Handler) {
         tokio::spawn(async move {
             let transport = Framed::new(
                 socket,
@@ -78,7 +109,7 @@ impl<Handler: MessageHandler> Receiver<Handler> {
             );
             let (mut writer, mut reader) = transport.split();
             while let Some(frame) = reader.next().await {
-                match frame.map_err(|e| NetworkError::FailedToReceiveMessage(peer, e)) {
+                match frame.map_err(|e| NetworkError::FailedToReceiveMessage(peer.clone(), e)) {
                     Ok(message) => {
                         if let Err(e) = handler.dispatch(&mut writer, message.freeze()).await {
                             warn!("{}", e);
@@ -157,7 +157,7 @@ impl Connection {
                     warn!("{}", error);
                 }
                 Err(e) => {
-                    warn!("{}", NetworkError::FailedToConnect(self.address, retry, e));
+                    warn!("{}", NetworkError::FailedToConnect(self.address.into(), retry, e));
                     let timer = sleep(Duration::from_millis(delay));
                     tokio::pin!(timer);
 
@@ -215,7 +215,7 @@ impl Connection {
                     Err(e) => {
                         // We failed to send the message, we put it back into the buffer.
                         self.buffer.push_front((data, handler));
-                        break 'connection NetworkError::FailedToSendMessage(self.address, e);
+                        break 'connection NetworkError::FailedToSendMessage(self.address.into(), e);
                     }
                 }
             }
@@ -229,7 +229,7 @@ impl Connection {
                 response = reader.next() => {
                     let (data, handler) = match pending_replies.pop_front() {
                         Some(message) => message,
-                        None => break 'connection NetworkError::UnexpectedAck(self.address)
+                        None => break 'connection NetworkError::UnexpectedAck(self.address.into())
                     };
                     match response {
                         Some(Ok(bytes)) => {
@@ -240,7 +240,7 @@ impl Connection {
                             // Something has gone wrong (either the channel dropped or we failed to read from it).
                             // Put the message back in the buffer, we will try to send it again.
                             pending_replies.push_front((data, handler));
-                            break 'connection NetworkError::FailedToReceiveAck(self.address);
+                            break 'connection NetworkError::FailedToReceiveAck(self.address.into());
                         }
                     }
                 },
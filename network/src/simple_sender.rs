@@ -8,12 +8,12 @@ use log::{info, warn};
 use rand::prelude::SliceRandom as _;
 use rand::rngs::SmallRng;
 use rand::SeedableRng as _;
-use tokio::net::TcpStream;
 use tokio::sync::mpsc::{channel, Receiver, Sender};
 use tokio_util::codec::{Framed, LengthDelimitedCodec};
 
 // Copyright(C) Facebook, Inc. and its affiliates.
 use crate::error::NetworkError;
+use crate::transport::{Address, Stream};
 
 #[cfg(test)]
 #[path = "tests/simple_sender_tests.rs"]
@@ -23,7 +23,7 @@ pub mod simple_sender_tests;
 /// We communicate with our 'connections' through a dedicated channel kept by the HashMap called `connections`.
 pub struct SimpleSender {
     /// A map holding the channels to our connections.
-    connections: HashMap<SocketAddr, Sender<Bytes>>,
+    connections: HashMap<Address, Sender<Bytes>>,
     /// Small RNG just used to shuffle nodes and randomize connections (not crypto related).
     rng: SmallRng,
 }
@@ -43,7 +43,7 @@ impl SimpleSender {
     }
 
     /// Helper function to spawn a new connection.
-    fn spawn_connection(address: SocketAddr) -> Sender<Bytes> {
+    fn spawn_connection(address: Address) -> Sender<Bytes> {
         let (tx, rx) = channel(1_000);
         Connection::spawn(address, rx);
         tx
@@ -52,6 +52,11 @@ impl SimpleSender {
     /// Try (best-effort) to send a message to a specific address.
     /// This is useful to answer sync requests.
     pub async fn send(&mut self, address: SocketAddr, data: Bytes) -> bool {
+        self.send_to(address.into(), data).await
+    }
+
+    /// Same as `send`, to a TCP address or a Unix domain socket.
+    pub async fn send_to(&mut self, address: Address, data: Bytes) -> bool {
         // Try to re-use an existing connection if possible.
         if let Some(tx) = self.connections.get(&address) {
             if tx.send(data.clone()).await.is_ok() {
@@ -60,7 +65,7 @@ impl SimpleSender {
         }
 
         // Otherwise make a new connection.
-        let tx = Self::spawn_connection(address);
+        let tx = Self::spawn_connection(address.clone());
         if tx.send(data).await.is_ok() {
             self.connections.insert(address, tx);
             true
@@ -93,13 +98,13 @@ impl SimpleSender {
 /// A connection is responsible to establish and keep alive (if possible) a connection with a single peer.
 struct Connection {
     /// The destination address.
-    address: SocketAddr,
+    address: Address,
     /// Channel from which the connection receives its commands.
     receiver: Receiver<Bytes>,
 }
 
 impl Connection {
-    fn spawn(address: SocketAddr, receiver: Receiver<Bytes>) {
+    fn spawn(address: Address, receiver: Receiver<Bytes>) {
         tokio::spawn(async move {
             Self { address, receiver }.run().await;
         });
@@ -108,7 +113,7 @@ impl Connection {
     /// Main loop trying to connect to the peer and transmit messages.
     async fn run(&mut self) {
         // Try to connect to the peer.
-        let (mut writer, mut reader) = match TcpStream::connect(self.address).await {
+        let (mut writer, mut reader) = match Stream::connect(&self.address).await {
             Ok(stream) => {
                 let codec = LengthDelimitedCodec::builder()
                     .length_field_length(8)
@@ -119,7 +124,7 @@ impl Connection {
             Err(e) => {
                 warn!(
                     "{}",
-                    NetworkError::FailedToConnect(self.address, /* retry */ 0, e)
+                    NetworkError::FailedToConnect(self.address.clone(), /* retry */ 0, e)
                 );
                 return;
             }
@@ -132,7 +137,7 @@ impl Connection {
             tokio::select! {
                 Some(data) = self.receiver.recv() => {
                     if let Err(e) = writer.send(data).await {
-                        warn!("{}", NetworkError::FailedToSendMessage(self.address, e));
+                        warn!("{}", NetworkError::FailedToSendMessage(self.address.clone(), e));
                         return;
                     }
                 },
@@ -143,7 +148,7 @@ impl Connection {
                         },
                         _ => {
                             // Something has gone wrong (either the channel dropped or we failed to read from it).
-                            warn!("{}", NetworkError::FailedToReceiveAck(self.address));
+                            warn!("{}", NetworkError::FailedToReceiveAck(self.address.clone()));
                             return;
                         }
                     }
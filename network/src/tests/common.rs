@@ -3,15 +3,42 @@ use bytes::Bytes;
 use futures::sink::SinkExt as _;
 use futures::stream::StreamExt as _;
 use std::net::SocketAddr;
-use tokio::net::TcpListener;
+use std::path::PathBuf;
+use tokio::net::{TcpListener, UnixListener};
 use tokio::task::JoinHandle;
 use tokio_util::codec::{Framed, LengthDelimitedCodec};
 
+/// The framing used by the senders and receivers of this crate.
+pub fn codec() -> LengthDelimitedCodec {
+    LengthDelimitedCodec::builder()
+        .length_field_length(8)
+        .max_frame_length(8 * 1024 * 1024 * 1024) /* 8 GiB */
+        .new_codec()
+}
+
 pub fn listener(address: SocketAddr, expected: String) -> JoinHandle<()> {
     tokio::spawn(async move {
         let listener = TcpListener::bind(&address).await.unwrap();
         let (socket, _) = listener.accept().await.unwrap();
-        let transport = Framed::new(socket, LengthDelimitedCodec::new());
+        let transport = Framed::new(socket, codec());
+        let (mut writer, mut reader) = transport.split();
+        match reader.next().await {
+            Some(Ok(received)) => {
+                assert_eq!(received, expected);
+                writer.send(Bytes::from("Ack")).await.unwrap()
+            }
+            _ => panic!("Failed to receive network message"),
+        }
+    })
+}
+
+pub fn unix_listener(path: PathBuf, expected: String) -> JoinHandle<()> {
+    // Bound before spawning, so that a sender may connect right away.
+    let _ = std::fs::remove_file(&path);
+    let listener = UnixListener::bind(&path).unwrap();
+    tokio::spawn(async move {
+        let (socket, _) = listener.accept().await.unwrap();
+        let transport = Framed::new(socket, codec());
         let (mut writer, mut reader) = transport.split();
         match reader.next().await {
             Some(Ok(received)) => {
@@ -1,6 +1,8 @@
 // Copyright(C) Facebook, Inc. and its affiliates.
 use super::*;
+use crate::common::codec;
 use futures::sink::SinkExt as _;
+use tokio::net::{TcpStream, UnixStream};
 use tokio::sync::mpsc::channel;
 use tokio::sync::mpsc::Sender;
 use tokio::time::{sleep, Duration};
@@ -37,7 +39,29 @@ async fn receive() {
     let sent = "Hello, world!";
     let bytes = Bytes::from(bincode::serialize(sent).unwrap());
     let stream = TcpStream::connect(address).await.unwrap();
-    let mut transport = Framed::new(stream, LengthDelimitedCodec::new());
+    let mut transport = Framed::new(stream, codec());
+    transport.send(bytes.clone()).await.unwrap();
+
+    // Ensure the message gets passed to the channel.
+    let message = rx.recv().await;
+    assert!(message.is_some());
+    let received = message.unwrap();
+    assert_eq!(received, sent);
+}
+
+#[tokio::test]
+async fn receive_unix() {
+    // Make the network receiver.
+    let path = std::env::temp_dir().join("network_receiver_tests_receive_unix.sock");
+    let (tx, mut rx) = channel(1);
+    Receiver::spawn_unix(path.clone(), TestHandler { deliver: tx });
+    sleep(Duration::from_millis(50)).await;
+
+    // Send a message.
+    let sent = "Hello, world!";
+    let bytes = Bytes::from(bincode::serialize(sent).unwrap());
+    let stream = UnixStream::connect(&path).await.unwrap();
+    let mut transport = Framed::new(stream, codec());
     transport.send(bytes.clone()).await.unwrap();
 
     // Ensure the message gets passed to the channel.
@@ -1,6 +1,6 @@
 // Copyright(C) Facebook, Inc. and its affiliates.
 use super::*;
-use crate::common::listener;
+use crate::common::{listener, unix_listener};
 use futures::future::try_join_all;
 
 #[tokio::test]
@@ -18,6 +18,21 @@ async fn simple_send() {
     assert!(handle.await.is_ok());
 }
 
+#[tokio::test]
+async fn simple_send_unix() {
+    // Run a Unix domain socket server.
+    let path = std::env::temp_dir().join("network_simple_sender_tests_simple_send_unix.sock");
+    let message = "Hello, world!";
+    let handle = unix_listener(path.clone(), message.to_string());
+
+    // Make the network sender and send the message.
+    let mut sender = SimpleSender::new();
+    sender.send_to(Address::Unix(path), Bytes::from(message)).await;
+
+    // Ensure the server received the message (ie. it did not panic).
+    assert!(handle.await.is_ok());
+}
+
 #[tokio::test]
 async fn broadcast() {
     // Run 3 TCP servers.
@@ -1,4 +1,5 @@
 // use std::fs;
+use std::path::PathBuf;
 
 use clap::{App, AppSettings, crate_name, crate_version, SubCommand};
 use env_logger::Env;
@@ -32,6 +33,8 @@ async fn main() {
                 .about("Runs a single node")
                 .args_from_usage("--quorum=<INT> 'The quorum size.'")
                 .args_from_usage("--obsido=<INT> 'The port that obsido use.'")
+                .args_from_usage("--consensus_socket=[PATH] 'A Unix domain socket to also accept client requests on'")
+                .args_from_usage("--obsido_socket=[PATH] 'A Unix domain socket to also accept obsido requests on'")
                 .args_from_usage("--keys=<FILE> 'The file containing the node keys'")
                 .args_from_usage("--committee=<FILE> 'The file containing committee information'")
                 .args_from_usage("--parameters=[FILE] 'The file containing the node parameters'")
@@ -71,13 +74,17 @@ async fn main() {
             let store_path = subm.value_of("store").unwrap();
             let obsido_port = subm.value_of("obsido").unwrap().parse().unwrap();
             let quorum_size = subm.value_of("quorum").unwrap().parse().unwrap();
+            let consensus_socket = subm.value_of("consensus_socket").map(PathBuf::from);
+            let obsido_socket = subm.value_of("obsido_socket").map(PathBuf::from);
             match Node::new(
                 committee_file,
                 key_file,
                 store_path,
                 parameters_file,
                 quorum_size,
-                obsido_port
+                obsido_port,
+                consensus_socket,
+                obsido_socket,
             )
                 .await
             {
@@ -1,4 +1,5 @@
 use std::collections::HashSet;
+use std::path::PathBuf;
 use std::sync::{Arc, Mutex};
 
 use bytes::Bytes;
@@ -29,7 +30,7 @@ pub struct Node {
     pub commit: Receiver<Block>,
     pub block_store: Store,
     last_defl_databank: Arc<Mutex<DeflDatabank>>,
-    cur_defl_databank: DeflDatabank,
+    cur_defl_databank: Arc<Mutex<DeflDatabank>>,
     voted_clients: HashSet<String>,
     defl_sender: DeflSender,
     quorum_size: usize,
@@ -43,6 +44,8 @@ impl Node {
         parameters: Option<&str>,
         quorum: usize,
         obsido_port: u16,
+        consensus_socket: Option<PathBuf>,
+        obsido_socket: Option<PathBuf>,
     ) -> Result<Self, ConfigError> {
         let (tx_commit, rx_commit) = channel(CHANNEL_CAPACITY);
         let (tx_consensus_to_mempool, rx_consensus_to_mempool) = channel(CHANNEL_CAPACITY);
@@ -65,7 +68,7 @@ impl Node {
 
         // Make DeFL components.
         let defl_sender = DeflSender::new();
-        let cur_defl_databank = DeflDatabank::new(0);
+        let cur_defl_databank = Arc::new(Mutex::new(DeflDatabank::new(0)));
         let last_defl_databank = Arc::new(Mutex::new(DeflDatabank::new(-1)));
 
         // Run the signature service.
@@ -79,12 +82,15 @@ impl Node {
             store.clone(),
             rx_consensus_to_mempool,
             tx_mempool_to_consensus,
+            consensus_socket,
         );
 
         Obsido::spawn(
             obsido_port,
+            obsido_socket,
             defl_sender.clone(),
             Arc::clone(&last_defl_databank),
+            Arc::clone(&cur_defl_databank),
         );
 
         // Run the consensus core.
@@ -127,13 +133,13 @@ impl Node {
             weights,
         } = client_request;
         let mut passive_response = None;
+        let mut cur_defl_databank = self.cur_defl_databank.lock().unwrap();
         let stat = match Method::from_i32(method) {
             Some(Method::UpdWeights) => {
                 info!("Batch tx: UPD_WEIGHTS");
-                match (target_epoch_id == self.cur_defl_databank.epoch_id, weights) {
+                match (target_epoch_id == cur_defl_databank.epoch_id, weights) {
                     (true, Some(weights)) => {
-                        if let Some(_) = self
-                            .cur_defl_databank
+                        if let Some(_) = cur_defl_databank
                             .client_weights
                             .insert(client_name, weights)
                         {
@@ -147,7 +153,7 @@ impl Node {
             }
             Some(Method::NewEpochVote) => {
                 info!("Batch tx: NEW_EPOCH_REQUEST.");
-                if target_epoch_id == self.cur_defl_databank.epoch_id {
+                if target_epoch_id == cur_defl_databank.epoch_id {
                     if self.voted_clients.insert(client_name.clone()) {
                         info!("Client [{}] voted.", client_name);
 
@@ -162,9 +168,9 @@ impl Node {
                         } else {
                             info!(
                                 "Enough clients voted. Received updated weights: {}.",
-                                self.cur_defl_databank.client_weights.len()
+                                cur_defl_databank.client_weights.len()
                             );
-                            self.cur_defl_databank.client_weights.iter().for_each(
+                            cur_defl_databank.client_weights.iter().for_each(
                                 |(client_name, _)| {
                                     info!("    Client [{}].", client_name);
                                 },
@@ -172,15 +178,16 @@ impl Node {
                             passive_response = Some(WeightsResponse {
                                 request_uuid: None,
                                 response_uuid: Uuid::new_v4().to_string(),
-                                r_last_epoch_id: self.cur_defl_databank.epoch_id,
-                                w_last: self.cur_defl_databank.client_weights.clone(),
+                                r_last_epoch_id: cur_defl_databank.epoch_id,
+                                w_last: cur_defl_databank.client_weights.clone(),
+                                speculative: false,
                             });
                             self.last_defl_databank
                                 .lock()
                                 .unwrap()
-                                .clone_from(&self.cur_defl_databank);
-                            self.cur_defl_databank.epoch_id += 1;
-                            self.cur_defl_databank.client_weights.clear();
+                                .clone_from(&*cur_defl_databank);
+                            cur_defl_databank.epoch_id += 1;
+                            cur_defl_databank.client_weights.clear();
                             self.voted_clients.clear();
                             info!("Entering new epoch.");
                             Status::Ok
@@ -1,5 +1,6 @@
 use std::error::Error;
 use std::net::SocketAddr;
+use std::path::PathBuf;
 use std::sync::{Arc, Mutex};
 
 use async_trait::async_trait;
@@ -28,17 +29,18 @@ struct TxReceiverHandler {
 impl MessageHandler for TxReceiverHandler {
     async fn dispatch(&self, writer: &mut Writer, message: Bytes) -> Result<(), Box<dyn Error>> {
 
+        // Acks name the request so that clients can pipeline requests on one connection.
         let imm_resp = match ObsidoRequest::decode(message.clone()) {
-            Ok(_) => {
+            Ok(request) => {
                 // Send the transaction to the batch maker.
                 self.tx_filter
                     .send(message.to_vec())
                     .await
                     .expect("Failed to send transaction");
 
-                "Ack"
+                format!("Ack {}", request.request_uuid)
             },
-            Err(_) => "Invalid OBSIDO Transaction"
+            Err(_) => "Invalid OBSIDO Transaction".to_string()
         };
 
         info!("OBSIDO HANDLER: Sending {} to client", &imm_resp);
@@ -55,18 +57,21 @@ pub struct ObsidoHandler {
     rx_filter: Receiver<Vec<u8>>,
     defl_sender: DeflSender,
     defl_databank: Arc<Mutex<DeflDatabank>>,
+    cur_defl_databank: Arc<Mutex<DeflDatabank>>,
 }
 
 impl ObsidoHandler {
     pub fn spawn(
         defl_sender: DeflSender,
         defl_databank: Arc<Mutex<DeflDatabank>>,
+        cur_defl_databank: Arc<Mutex<DeflDatabank>>,
         rx_filter: Receiver<Vec<u8>>,
     ) {
         tokio::spawn(async move {
             Self {
                 defl_sender,
                 defl_databank,
+                cur_defl_databank,
                 rx_filter,
             }
                 .run()
@@ -86,6 +91,7 @@ impl ObsidoHandler {
                     request_uuid,
                     client_name,
                     register_info,
+                    min_clients,
                 } = client_request;
                 info!("filtering transactions {}", &request_uuid);
                 // Method::FetchWLast as i32;
@@ -98,6 +104,7 @@ impl ObsidoHandler {
                             response_uuid: response_uuid.clone(),
                             w_last: defl_databank.client_weights,
                             r_last_epoch_id: defl_databank.epoch_id,
+                            speculative: false,
                         };
                         match self.defl_sender
                             .respond_to_all_client(response)
@@ -110,6 +117,36 @@ impl ObsidoHandler {
                             Err(_) => warn!("Failed to respond FETCH_W_LAST [{}].", client_name),
                         }
                     }
+                    Some(Method::FetchWCur) => {
+                        // The committed-so-far weights of the ongoing epoch, for speculative training.
+                        // Below `min_clients` only the epoch id is sent, the client keeps polling.
+                        let defl_databank = {
+                            let cur_defl_databank = self.cur_defl_databank.lock().unwrap();
+                            if cur_defl_databank.client_weights.len() >= min_clients as usize {
+                                cur_defl_databank.clone()
+                            } else {
+                                DeflDatabank::new(cur_defl_databank.epoch_id)
+                            }
+                        };
+                        let response_uuid = uuid::Uuid::new_v4().to_string();
+                        let response = WeightsResponse {
+                            request_uuid: Some(request_uuid.clone()),
+                            response_uuid: response_uuid.clone(),
+                            w_last: defl_databank.client_weights,
+                            r_last_epoch_id: defl_databank.epoch_id,
+                            speculative: true,
+                        };
+                        match self.defl_sender
+                            .respond_weights_to_client(client_name.clone(), response)
+                            .await
+                        {
+                            Ok(len) => info!(
+                                "Responded FETCH_W_CUR [{}]\tepoch_id={}\tbytes={}\trequest_uuid={}\tresponse_uuid={}",
+                                client_name, defl_databank.epoch_id, len, request_uuid, response_uuid
+                            ),
+                            Err(_) => warn!("Failed to respond FETCH_W_CUR [{}].", client_name),
+                        }
+                    }
                     Some(Method::ClientRegister) => {
                         if let Some(register_info) = register_info {
                             info!("Registering client {}", &client_name);
@@ -136,17 +173,24 @@ pub struct Obsido;
 impl Obsido {
     pub fn spawn(
         obsido_port: u16,
+        obsido_socket: Option<PathBuf>,
         defl_sender: DeflSender,
         defl_databank: Arc<Mutex<DeflDatabank>>,
+        cur_defl_databank: Arc<Mutex<DeflDatabank>>,
     ) {
         let (tx_filter, rx_filter) = channel(CHANNEL_CAPACITY);
 
 
         // We first receive clients' transactions from the network.
         let address: SocketAddr = SocketAddr::new("127.0.0.1".parse().unwrap(), obsido_port);
-        NetworkReceiver::spawn(address, /* handler */ TxReceiverHandler { tx_filter });
+        let handler = TxReceiverHandler { tx_filter };
+        if let Some(path) = obsido_socket {
+            info!("Obsido listening to client transactions on {}", path.display());
+            NetworkReceiver::spawn_unix(path, handler.clone());
+        }
+        NetworkReceiver::spawn(address, /* handler */ handler);
 
-        ObsidoHandler::spawn(defl_sender, defl_databank, rx_filter);
+        ObsidoHandler::spawn(defl_sender, defl_databank, cur_defl_databank, rx_filter);
 
         info!("Obsido listening to client transactions on {}", address);
     }
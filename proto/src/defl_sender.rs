@@ -1,14 +1,16 @@
 use std::collections::HashMap;
 use std::net::SocketAddr;
+use std::path::PathBuf;
 use std::sync::{Arc, PoisonError};
 use std::sync::RwLock;
 
 use prost::Message;
 use thiserror::Error;
 
-use network::SimpleSender;
+use network::{Address, SimpleSender};
 
-use crate::defl::{Response, WeightsResponse};
+use crate::defl::client_push::Body;
+use crate::defl::{ClientPush, Response, WeightsResponse};
 use crate::defl_sender::RespondError::ContactsLockPoisonError;
 use crate::SimpleRegisterInfo;
 
@@ -52,46 +54,86 @@ impl DeflSender {
         }
     }
 
-    /// Returns the bytes of the response if successful, otherwise returns an error.
-    pub async fn respond_to_client(
-        &mut self,
-        client_name: String,
-        response: Response,
-    ) -> Result<usize, RespondError> {
-        let SimpleRegisterInfo {
-            host,
-            port,
-            pasv_host: _,
-            pasv_port: _,
-        } = self
+    fn contact(&self, client_name: &str) -> Result<SimpleRegisterInfo, RespondError> {
+        Ok(self
             .contacts
             .read()?
-            .get(&client_name)
+            .get(client_name)
             .ok_or(RespondError::RegistrationError {
-                client_name: client_name.clone(),
+                client_name: client_name.to_string(),
             })?
-            .clone();
-        let data: Vec<u8> = response.encode_to_vec();
+            .clone())
+    }
+
+    async fn send_to(
+        &mut self,
+        client_name: String,
+        address: Address,
+        data: Vec<u8>,
+    ) -> Result<usize, RespondError> {
         let length = data.len();
-        let address = SocketAddr::new(host.parse().unwrap(), port);
-        if self.sender.send(address, data.into()).await {
+        if self.sender.send_to(address, data.into()).await {
             Ok(length)
         } else {
             Err(RespondError::NetworkError { client_name })
         }
     }
 
+    /// Returns the bytes of the response if successful, otherwise returns an error.
+    pub async fn respond_to_client(
+        &mut self,
+        client_name: String,
+        response: Response,
+    ) -> Result<usize, RespondError> {
+        let contact = self.contact(&client_name)?;
+        let data: Vec<u8> = if contact.multiplexed {
+            push(Body::Response(response))
+        } else {
+            response.encode_to_vec()
+        };
+        self.send_to(client_name, active_address(&contact), data).await
+    }
+
+    /// Sends weights to one client only, on its passive port unless it is multiplexed.
+    /// Returns the bytes of the response if successful, otherwise returns an error.
+    pub async fn respond_weights_to_client(
+        &mut self,
+        client_name: String,
+        response: WeightsResponse,
+    ) -> Result<usize, RespondError> {
+        let contact = self.contact(&client_name)?;
+        let (data, address) = if contact.multiplexed {
+            (push(Body::Weights(response)), active_address(&contact))
+        } else {
+            (response.encode_to_vec(), passive_address(&contact))
+        };
+        self.send_to(client_name, address, data).await
+    }
+
     /// Returns the bytes of the response if successful, otherwise returns an error.
     pub async fn respond_to_all_client(
         &mut self,
         response: WeightsResponse,
     ) -> Result<usize, RespondError> {
         let contacts = self.contacts.read()?.clone();
-        let data: Vec<u8> = response.encode_to_vec();
-        let length = data.len();
-        for (_, SimpleRegisterInfo { pasv_host, pasv_port, host: _host, port: _port }) in contacts {
-            let address = SocketAddr::new(pasv_host.parse().unwrap(), pasv_port);
-            self.sender.send(address, data.clone().into()).await;
+        // weights are large, encode each framing once and only if some client needs it
+        let data: Vec<u8> = if contacts.values().any(|info| !info.multiplexed) {
+            response.encode_to_vec()
+        } else {
+            Vec::new()
+        };
+        let length = response.encoded_len();
+        let pushed: Vec<u8> = if contacts.values().any(|info| info.multiplexed) {
+            push(Body::Weights(response))
+        } else {
+            Vec::new()
+        };
+        for (_, contact) in contacts {
+            if contact.multiplexed {
+                self.sender.send_to(active_address(&contact), pushed.clone().into()).await;
+            } else {
+                self.sender.send_to(passive_address(&contact), data.clone().into()).await;
+            }
         }
         Ok(length)
     }
@@ -107,3 +149,20 @@ impl DeflSender {
             .insert(client_name, register_info);
     }
 }
+
+/// Where responses go, the callback socket of a multiplexed client if it registered one.
+fn active_address(contact: &SimpleRegisterInfo) -> Address {
+    match (&contact.callback_path, contact.multiplexed) {
+        (Some(path), true) => Address::Unix(PathBuf::from(path)),
+        _ => Address::Tcp(SocketAddr::new(contact.host.parse().unwrap(), contact.port)),
+    }
+}
+
+fn passive_address(contact: &SimpleRegisterInfo) -> Address {
+    Address::Tcp(SocketAddr::new(contact.pasv_host.parse().unwrap(), contact.pasv_port))
+}
+
+/// A frame of the multiplexed channel, see RegisterInfo.multiplexed.
+fn push(body: Body) -> Vec<u8> {
+    ClientPush { body: Some(body) }.encode_to_vec()
+}
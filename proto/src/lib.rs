@@ -12,6 +12,8 @@ pub struct SimpleRegisterInfo {
     pub port: u16,
     pub pasv_host: String,
     pub pasv_port: u16,
+    pub multiplexed: bool,
+    pub callback_path: Option<String>,
 }
 
 impl Into<SimpleRegisterInfo> for defl::RegisterInfo {
@@ -21,6 +23,8 @@ impl Into<SimpleRegisterInfo> for defl::RegisterInfo {
             port: self.port as u16,
             pasv_host: self.pasv_host,
             pasv_port: self.pasv_port as u16,
+            multiplexed: self.multiplexed,
+            callback_path: self.callback_path,
         }
     }
 }
@@ -13,7 +13,7 @@ import subprocess
 import uuid
 from logging import info, warning
 from time import sleep
-from typing import List
+from typing import List, Optional
 
 from benchmark.defl.types import ClientConfig
 
@@ -26,12 +26,15 @@ def gen_client_cmd(python_path: str, client_name: str, client_config_path: str):
     )
 
 
-def gen_server_cmd(rust_node_path: str, id: int, obsido_port: int, quorum_size: int):
+def gen_server_cmd(rust_node_path: str, id: int, obsido_port: int, quorum_size: int,
+                   consensus_socket: Optional[str] = None, obsido_socket: Optional[str] = None):
     return (
         f"{rust_node_path} -vv run "
         f"--quorum {quorum_size} "
         f"--obsido {obsido_port} "
-        f"--keys .node-{id}.json "
+        + (f"--consensus_socket {consensus_socket} " if consensus_socket else "")
+        + (f"--obsido_socket {obsido_socket} " if obsido_socket else "")
+        + f"--keys .node-{id}.json "
         f"--committee .committee.json "
         f"--store .db-{id} "
         f"--parameters .parameters.json "
@@ -166,7 +169,9 @@ if __name__ == '__main__':
 
         server_sessions.append((
             client_config['server_name'] + '-' + str(uuid.uuid4())[:8],
-            gen_server_cmd(NODE_PATH, id, client_config['obsido_port'], quorum_size=quorum_size),
+            gen_server_cmd(NODE_PATH, id, client_config['obsido_port'], quorum_size=quorum_size,
+                           consensus_socket=client_config.get('consensus_socket'),
+                           obsido_socket=client_config.get('obsido_socket')),
             './benchmark',
             client_config['env']))
         